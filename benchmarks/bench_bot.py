@@ -0,0 +1,373 @@
+import argparse
+import atexit
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import paramiko
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = '123456:bench'
+
+COMMANDS = [
+    [('/start', 1)],
+    [('/help', 1)],
+    [('/find_email', 1), ('user@example.com и admin@example.org', 2), ('да', 1)],
+    [('/find_phone_number', 1), ('+7 (912) 345-67-89, 8 912 345 67 89', 2), ('нет', 1)],
+    [('/verify_password', 1), ('Qwerty123!', 1)],
+    [('/get_release', 1)],
+    [('/get_uname', 1)],
+    [('/get_uptime', 1)],
+    [('/get_df', 1)],
+    [('/get_free', 1)],
+    [('/get_mpstat', 1)],
+    [('/get_w', 1)],
+    [('/get_auths', 1)],
+    [('/get_critical', 1)],
+    [('/get_ps', 1)],
+    [('/get_ss', 1)],
+    [('/get_ss diff', 1)],
+    [('/get_apt_list', 1)],
+    [('/get_services', 1)],
+    [('/get_services failed', 1)],
+    [('/get_repl_logs', 1)],
+    [('/get_repl_status', 1)],
+    [('/get_emails', 1)],
+    [('/get_phone_numbers', 1)],
+    [('/get_alerts', 1)],
+    [('/chart load', 1)],
+    [('/stats', 1)],
+]
+
+
+PROC_FILES = {
+    '/proc/loadavg': '0.42 0.35 0.30 2/311 4242\n',
+    '/proc/uptime': '356400.17 1401234.56\n',
+    '/proc/meminfo': 'MemTotal:        8148012 kB\nMemFree:         2113516 kB\nMemAvailable:    5531204 kB\n'
+                     'Buffers:          203460 kB\nCached:          3012344 kB\nShmem:             81232 kB\n'
+                     'SReclaimable:    241800 kB\nSwapTotal:       2097148 kB\nSwapFree:        2097148 kB\n',
+    '/proc/stat': 'cpu  1040221 1201 312044 9012332 20112 0 4410 0 0 0\n'
+                  'cpu0 520110 600 156022 4506166 10056 0 2205 0 0 0\n'
+                  'cpu1 520111 601 156022 4506166 10056 0 2205 0 0 0\nintr 1\n',
+    '/proc/net/tcp': '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n'
+                     '   0: 00000000:0016 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 1 1\n'
+                     '   1: 0100007F:1538 0100007F:D2F0 01 00000000:00000000 00:00000000 00000000   999        0 2 1\n',
+}
+
+
+def proc_batch(command):
+    lines = []
+    for path in re.findall(r'/proc/[\w/]+', command):
+        lines.append(f'==> {path} <==\n{PROC_FILES.get(path, "")}')
+    if 'stat -f' in command:
+        lines.append('==> statfs <==\n25671918 12042113 10932211 4096\n')
+    return '\n'.join(lines).encode()
+
+
+def canned_output(command, size):
+    if 'tail -v -n +1' in command:
+        return proc_batch(command)
+    if 'systemctl' in command:
+        line = 'bench{0}.service loaded active running Benchmark service {0}\n'
+    else:
+        line = '{0:06d} benchmark output line\n'
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        lines.append(line.format(i))
+        total += len(lines[-1])
+        i += 1
+    return ''.join(lines).encode()
+
+
+class FakeSSHServer(paramiko.ServerInterface):
+    def __init__(self, output_size, latency):
+        self.output_size = output_size
+        self.latency = latency
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.run_command, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def run_command(self, channel, command):
+        time.sleep(self.latency)
+        try:
+            output = canned_output(command, self.output_size)
+            if command.endswith('| gzip -1 -c'):
+                output = gzip.compress(output, compresslevel=1)
+            channel.sendall(output)
+            channel.send_exit_status(0)
+        finally:
+            channel.close()
+
+
+def start_ssh_server(output_size, latency):
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(100)
+
+    def serve(client):
+        transport = paramiko.Transport(client)
+        transport.add_server_key(host_key)
+        transport.start_server(server=FakeSSHServer(output_size, latency))
+
+    def accept():
+        while True:
+            client, _ = listener.accept()
+            threading.Thread(target=serve, args=(client,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.updates = []
+        self.replies = {}
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.first_poll = None
+
+    def push(self, chat_id, text):
+        with self.condition:
+            message = {
+                'message_id': self.next_message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+                'text': text,
+            }
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            self.updates.append({'update_id': self.next_update_id, 'message': message})
+            self.next_update_id += 1
+            self.next_message_id += 1
+            self.condition.notify_all()
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            if self.first_poll is None:
+                self.first_poll = time.monotonic()
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return self.updates[:100]
+
+    def reply(self, method, params):
+        chat_id = int(params.get('chat_id', 0))
+        with self.condition:
+            self.replies.setdefault(chat_id, []).append(time.monotonic())
+            self.next_message_id += 1
+            self.condition.notify_all()
+            return {
+                'message_id': self.next_message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'bench'},
+                'text': params.get('text', ''),
+            }
+
+    def wait_replies(self, chat_id, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.replies.get(chat_id, [])) < count:
+                if time.monotonic() >= deadline:
+                    return None
+                self.condition.wait(deadline - time.monotonic())
+            return self.replies[chat_id][count - 1]
+
+
+def parse_params(headers, body):
+    content_type = headers.get('Content-Type', '')
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        return {part.get_param('name', header='content-disposition'): part.get_content()
+                for part in message.iter_parts() if not part.get_filename()}
+    return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+
+def start_telegram_server(telegram):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            method = self.path.rsplit('/', 1)[-1]
+            params = parse_params(self.headers, self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if method == 'getMe':
+                result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+            elif method == 'getUpdates':
+                result = telegram.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+            elif method.startswith(('send', 'edit')):
+                result = telegram.reply(method, params)
+            else:
+                result = True
+            body = json.dumps({'ok': True, 'result': result}).encode()
+            try:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except ConnectionError:
+                pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+
+def run_user(telegram, chat_id, rounds, timeout, latencies, errors):
+    expected = 0
+    for _ in range(rounds):
+        for steps in COMMANDS:
+            name = steps[0][0]
+            for text, replies in steps:
+                start = time.monotonic()
+                expected += replies
+                telegram.push(chat_id, text)
+                reply_time = telegram.wait_replies(chat_id, expected, timeout)
+                if reply_time is None:
+                    errors[name] = errors.get(name, 0) + 1
+                    expected = len(telegram.replies.get(chat_id, []))
+                    break
+                latencies.setdefault(name, []).append(reply_time - start)
+
+
+def start_bot(telegram, env, workdir):
+    telegram.first_poll = None
+    started = time.monotonic()
+    bot = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bot.py')], cwd=workdir, env=env,
+                           stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, 'bot.log'), 'w'))
+    while telegram.first_poll is None:
+        if bot.poll() is not None:
+            with open(os.path.join(workdir, 'bot.log')) as f:
+                log = ''.join(f.readlines()[-20:])
+            sys.exit(f'bot exited with code {bot.returncode}:\n{log}')
+        time.sleep(0.005)
+    return bot, telegram.first_poll - started
+
+
+def stop_bot(bot):
+    bot.terminate()
+    bot.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark with local SSH and Telegram Bot API stand-ins')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--output-size', type=int, default=2000, help='bytes returned by each SSH command')
+    parser.add_argument('--ssh-latency', type=float, default=0.01, help='seconds before each SSH command answers')
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--startup-runs', type=int, default=5, help='bot restarts used to measure startup time')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory with the bot log')
+    args = parser.parse_args()
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+    telegram = FakeTelegram()
+    telegram_port = start_telegram_server(telegram)
+    ssh_port = start_ssh_server(args.output_size, args.ssh_latency)
+    workdir = tempfile.mkdtemp(prefix='ptbot-bench-')
+    if not args.keep:
+        atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    user_ids = [1000 + i for i in range(args.users)]
+
+    env = dict(os.environ)
+    env.update({
+        'TOKEN': TOKEN,
+        'TELEGRAM_BASE_URL': f'http://127.0.0.1:{telegram_port}/bot',
+        'DATABASE_URL': args.database_url or f'sqlite:///{workdir}/bench.db',
+        'SSH_HOST': '127.0.0.1',
+        'SSH_PORT': str(ssh_port),
+        'SSH_USERNAME': 'bench',
+        'SSH_PASSWORD': 'bench',
+        'SSH_KNOWN_HOSTS': os.path.join(workdir, 'known_hosts'),
+        'ADMIN_IDS': ','.join(map(str, user_ids)),
+        'METRICS_INTERVAL': '0',
+        'ALERT_INTERVAL': '0',
+    })
+    for name in ('RATE_LIMIT_CHEAP', 'RATE_LIMIT_EXPENSIVE', 'RATE_LIMIT_CHAT_SENDS'):
+        env.setdefault(name, '1000:1000')
+    env.setdefault('RATE_LIMIT_SENDS', '1000')
+    startups = []
+    for _ in range(args.startup_runs):
+        bot, startup = start_bot(telegram, env, workdir)
+        startups.append(startup)
+        stop_bot(bot)
+
+    bot, startup = start_bot(telegram, env, workdir)
+    startups.append(startup)
+    try:
+        latencies, errors = {}, {}
+        threads = [threading.Thread(target=run_user, args=(telegram, chat_id, args.rounds, args.timeout, latencies, errors))
+                   for chat_id in user_ids]
+        begin = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - begin
+    finally:
+        stop_bot(bot)
+
+    total = sum(len(values) for values in latencies.values())
+    print(f'startup (process start to first getUpdates, {len(startups)} runs): '
+          f'p50 {percentile(startups, 0.5):.0f} ms, min {min(startups) * 1000:.0f} ms, max {max(startups) * 1000:.0f} ms')
+    print(f'{args.users} users x {args.rounds} rounds: {total} updates in {elapsed:.2f} s, {total / elapsed:.1f} updates/s')
+    print(f'{"command":<24}{"n":>6}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"errors":>8}')
+    for steps in COMMANDS:
+        name = steps[0][0]
+        values = latencies.get(name, [])
+        if values:
+            print(f'{name:<24}{len(values):>6}{percentile(values, 0.5):>10.1f}'
+                  f'{percentile(values, 0.95):>10.1f}{percentile(values, 0.99):>10.1f}{errors.get(name, 0):>8}')
+        else:
+            print(f'{name:<24}{0:>6}{"-":>10}{"-":>10}{"-":>10}{errors.get(name, 0):>8}')
+    if args.keep:
+        print(f'bot log: {workdir}/bot.log')
+
+
+if __name__ == '__main__':
+    main()
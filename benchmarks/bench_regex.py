@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bot import EMAIL_RE, PHONE_RE, PASSWORD_RE  # noqa: E402
+
+WORDS = ['сервер', 'диск', 'память', 'ошибка', 'отчёт', 'пользователь', 'the', 'disk', 'is', 'full',
+         'please', 'check', 'replication', 'status', 'and', 'restart', 'service', 'ok', 'нет', 'да']
+
+
+def clean_text(rng, size):
+    parts = []
+    total = 0
+    while total < size:
+        parts.append(rng.choice(WORDS))
+        total += len(parts[-1]) + 1
+    return ' '.join(parts)
+
+
+def random_email(rng):
+    return f'{rng.choice(WORDS[6:])}.{rng.randrange(1000)}@{rng.choice(["mail", "example", "corp"])}.{rng.choice(["ru", "com", "org"])}'
+
+
+def random_phone(rng):
+    return rng.choice(['+7 ({}) {}-{}-{}', '7{}{}{}{}', '+7-{}-{}-{}-{}']).format(
+        rng.randrange(900, 1000), rng.randrange(100, 1000), rng.randrange(10, 100), rng.randrange(10, 100))
+
+
+def dense_contacts(rng, size):
+    parts = []
+    total = 0
+    while total < size:
+        parts.append(rng.choice([random_email, random_phone, lambda r: r.choice(WORDS)])(rng))
+        total += len(parts[-1]) + 1
+    return ' '.join(parts)
+
+
+def log_lines(rng, size):
+    lines = []
+    total = 0
+    while total < size:
+        lines.append(f'2024-10-0{rng.randrange(1, 10)} 12:{rng.randrange(60):02d}:{rng.randrange(60):02d} host '
+                     f'postgres[{rng.randrange(1, 65535)}]: LOG:  {clean_text(rng, 60)} '
+                     f'client=10.0.{rng.randrange(256)}.{rng.randrange(256)} user={rng.choice(WORDS)}_{rng.randrange(100)}')
+        total += len(lines[-1]) + 1
+    return '\n'.join(lines)
+
+
+CORPORA = {
+    'clean': clean_text,
+    'contacts': dense_contacts,
+    'logs': log_lines,
+    # Long runs of address characters without an '@' or a valid domain, the
+    # inputs that make unanchored email patterns backtrack quadratically.
+    'run_no_at': lambda rng, size: 'a' * size,
+    'dotted_domain': lambda rng, size: 'x@' + 'a.' * (size // 2) + '1',
+    'password_no_digit': lambda rng, size: 'Aa!' + 'Ab' * (size // 2),
+}
+
+# Matches of the original unanchored email pattern that a faster one must keep.
+EMAIL_CASES = {
+    'a@b.com.x@c.org': ['a@b.com', '.x@c.org'],
+    'foo@bar.ru-baz@qux.com': ['foo@bar.ru', '-baz@qux.com'],
+    'mail a.b@c.ru, d_e@f.com': ['a.b@c.ru', 'd_e@f.com'],
+    'x@y.comz@w.org': ['x@y.comz'],
+}
+
+PATTERNS = {
+    'email': lambda text: EMAIL_RE.findall(text),
+    'phone': lambda text: PHONE_RE.findall(text),
+    'password': lambda text: PASSWORD_RE.match(text),
+}
+
+
+def measure(function, text, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of the email, phone and password patterns')
+    parser.add_argument('--size', type=int, default=1 << 20, help='corpus size in characters')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--min-mbps', type=float, default=5.0, help='fail below this throughput')
+    parser.add_argument('--max-growth', type=float, default=8.0,
+                        help='fail if 4x more input takes more than this many times longer')
+    parser.add_argument('--save', help='write results to a JSON file')
+    parser.add_argument('--compare', help='JSON file from --save to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against --compare')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    failures = []
+    for text, expected in EMAIL_CASES.items():
+        found = EMAIL_RE.findall(text)
+        if found != expected:
+            failures.append(f'email {text!r}: {found}, expected {expected}')
+    print(f'{"pattern":<10}{"corpus":<20}{"MB/s":>10}{"growth x4":>11}')
+    for corpus, generate in CORPORA.items():
+        small = generate(random.Random(args.seed), args.size // 4)
+        large = generate(random.Random(args.seed), args.size)
+        megabytes = len(large.encode()) / 1e6
+        for pattern, function in PATTERNS.items():
+            small_time = measure(function, small, args.repeats)
+            large_time = measure(function, large, args.repeats)
+            throughput = megabytes / large_time
+            growth = large_time / max(small_time, 1e-9)
+            key = f'{pattern}/{corpus}'
+            results[key] = throughput
+            print(f'{pattern:<10}{corpus:<20}{throughput:>10.1f}{growth:>11.1f}')
+            if throughput < args.min_mbps:
+                failures.append(f'{key}: {throughput:.1f} MB/s is below {args.min_mbps} MB/s')
+            if growth > args.max_growth:
+                failures.append(f'{key}: 4x input took {growth:.1f}x longer, matching is superlinear')
+            if key in baseline and throughput < baseline[key] * (1 - args.tolerance):
+                failures.append(f'{key}: {throughput:.1f} MB/s, baseline {baseline[key]:.1f} MB/s')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    for failure in failures:
+        print(f'REGRESSION {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,36 @@
 import logging
 import re
 import os
+import time
+import asyncio
+import json
+import functools
+import io
+import signal
+import secrets
+import select
+import codecs
+import shlex
+import zlib
+import threading
+import socket
+import subprocess
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import cProfile
+import pstats
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from contextvars import ContextVar
+from fnmatch import fnmatch
 from dotenv import load_dotenv
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, ConversationHandler
-from sqlalchemy import create_engine, Column, String, Integer
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import paramiko
+from telegram import BotCommand, Update
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.ext import (Application, ApplicationHandlerStop, BasePersistence, BaseUpdateProcessor, CommandHandler,
+                          MessageHandler, PersistenceInput, TypeHandler, filters, CallbackContext,
+                          ConversationHandler)
 
 load_dotenv()
 
@@ -21,46 +44,1552 @@ logger = logging.getLogger(__name__)
 FIND_EMAIL, FIND_PHONE, VERIFY_PASSWORD = range(3)
 SAVE_EMAIL, SAVE_PHONE = range(4, 6)
 
-engine = create_engine(f'postgresql://{os.getenv("DB_USER")}:{os.getenv("DB_PASSWORD")}@{os.getenv("DB_HOST")}:{os.getenv("DB_PORT")}/{os.getenv("DB_DATABASE")}')
-Base = declarative_base()
+# An address starts at the beginning of a token or right after a top-level
+# domain that ended the previous match ('a@b.com.x@c.org'), the only places
+# where the unanchored pattern could start one. The local part is capped at 64
+# characters and the domain at 253 (RFC 5321), so a long run of address
+# characters costs a bounded scan per position instead of one to its end.
+EMAIL_RE = re.compile(r'[a-zA-Z0-9._%+-](?<![a-zA-Z][a-zA-Z])(?<![0-9._%+-].)(?<![^a-zA-Z][a-zA-Z].)'
+                      r'[a-zA-Z0-9._%+-]{0,63}@[a-zA-Z0-9.-]{1,253}\.[a-zA-Z]{2,}')
+PHONE_RE = re.compile(r'\+?7[-\s]?\(?\d{3}\)?[-\s]?\d{3}[-\s]?\d{2}[-\s]?\d{2}')
+PASSWORD_RE = re.compile(r'^(?=.*[A-Z])(?=.*[a-z])(?=.*\d)(?=.*[@$!%*#?&])[A-Za-z\d@$!%* #?&]{8,}$')
 
-class Email(Base):
-    __tablename__ = 'emails'
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    email = Column(String, nullable=False)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT')
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
 
-    def __init__(self, email):
-        self.email = email
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', '32'))
 
-class Phone(Base):
-    __tablename__ = 'phones'
-    id = Column(String, primary_key=True)
-    phone = Column(String)
+RATE_LIMITS = {
+    'cheap': os.getenv('RATE_LIMIT_CHEAP', '1:10'),
+    'expensive': os.getenv('RATE_LIMIT_EXPENSIVE', '0.2:3'),
+}
+RATE_LIMIT_SENDS = float(os.getenv('RATE_LIMIT_SENDS', '30'))
+RATE_LIMIT_CHAT_SENDS = os.getenv('RATE_LIMIT_CHAT_SENDS', '1:3')
+MESSAGE_LIMIT = 4096
+SSH_MAX_OUTPUT = int(os.getenv('SSH_MAX_OUTPUT', str(256 * 1024)))
+SSH_COMMAND_TIMEOUT = float(os.getenv('SSH_COMMAND_TIMEOUT', '60'))
+SSH_CONNECT_TIMEOUT = float(os.getenv('SSH_CONNECT_TIMEOUT', '10'))
+SSH_EXEC_TIMEOUT = float(os.getenv('SSH_EXEC_TIMEOUT', '10'))
+SSH_REMOTE_TIMEOUT = os.getenv('SSH_REMOTE_TIMEOUT', '1') == '1'
+SSH_STREAM_INTERVAL = float(os.getenv('SSH_STREAM_INTERVAL', '2'))
+SSH_CHUNK_SIZE = 32768
+SESSION_MARKER = 'ptbot-session '
+SSH_COMPRESS = os.getenv('SSH_COMPRESS', '0') == '1'
+SSH_GZIP_THRESHOLD = int(os.getenv('SSH_GZIP_THRESHOLD', str(64 * 1024)))
+SSH_KEY_FILE = os.getenv('SSH_KEY_FILE')
+SSH_KEY_PASSPHRASE = os.getenv('SSH_KEY_PASSPHRASE')
+SSH_USE_AGENT = os.getenv('SSH_USE_AGENT', '1') == '1'
+SSH_KNOWN_HOSTS = os.path.expanduser(os.getenv('SSH_KNOWN_HOSTS', '~/.ssh/ptbot_known_hosts'))
+SSH_HOST_KEY_POLICY = os.getenv('SSH_HOST_KEY_POLICY', 'tofu')
+SSH_KEEPALIVE = int(os.getenv('SSH_KEEPALIVE', '30'))
+SSH_MAX_SESSIONS = int(os.getenv('SSH_MAX_SESSIONS', '8'))
+LOCAL_HOSTS = {host for host in os.getenv('LOCAL_HOSTS', '').split(',') if host}
+PROBE_MODE = os.getenv('PROBE_MODE', 'shell')
+PROC_HEADER_RE = re.compile(r'==> (.+) <==')
+METRICS_PROC_FILES = ('/proc/loadavg', '/proc/meminfo', '/proc/stat', 'statfs')
+SOCKET_PROC_FILES = ('/proc/net/tcp', '/proc/net/tcp6', '/proc/net/udp', '/proc/net/udp6')
+TCP_STATES = {
+    '01': 'ESTAB', '02': 'SYN-SENT', '03': 'SYN-RECV', '04': 'FIN-WAIT-1', '05': 'FIN-WAIT-2', '06': 'TIME-WAIT',
+    '07': 'UNCONN', '08': 'CLOSE-WAIT', '09': 'LAST-ACK', '0A': 'LISTEN', '0B': 'CLOSING',
+}
+SEND_METHODS = ('send', 'edit', 'copy', 'forward')
 
-Base.metadata.create_all(engine)
+DB_RETRY_INTERVAL = int(os.getenv('DB_RETRY_INTERVAL', '10'))
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '0'))
+CONVERSATION_TIMEOUT = int(os.getenv('CONVERSATION_TIMEOUT', '300'))
+PENDING_LIMIT = int(os.getenv('PENDING_LIMIT', '1000'))
+PENDING_KEYS = ('emails', 'phones')
+
+PS_COMMAND = 'ps u -N --sid "$(ps -o sid= -p $$)"'
+SERVICES_COMMAND = 'systemctl list-units --type=service --plain --no-legend --no-pager'
+SERVICES_CACHE_TTL = int(os.getenv('SERVICES_CACHE_TTL', '30'))
+SERVICE_STATE_ORDER = {'failed': 0, 'activating': 1, 'deactivating': 2, 'reloading': 3, 'active': 4, 'inactive': 5}
+
+services_cache = {}
+
+METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', '60'))
+METRICS_HISTORY = int(os.getenv('METRICS_HISTORY', '360'))
+METRICS_ROLLUP = int(os.getenv('METRICS_ROLLUP', '10'))
+METRICS_ROLLUP_HISTORY = int(os.getenv('METRICS_ROLLUP_HISTORY', '1008'))
+METRICS_COMMAND = ('cat /proc/loadavg; grep -E "^(MemTotal|MemAvailable):" /proc/meminfo; '
+                   'df -P / | tail -n 1; head -n 1 /proc/stat')
+METRIC_LABELS = {
+    'load': 'Нагрузка (load average 1m)',
+    'mem': 'Использование памяти, %',
+    'disk': 'Заполненность диска /, %',
+    'cpu': 'Загрузка CPU, %',
+    'crit': 'Критические события journalctl',
+    'repl_lag': 'Отставание репликации, байт',
+}
+
+ALERT_INTERVAL = int(os.getenv('ALERT_INTERVAL', '60'))
+ALERT_RULES = os.getenv('ALERT_RULES', 'disk>=90/85,mem>=90/80,crit>=1,repl_lag>=16777216/8388608')
+# Metrics that count new events since the previous probe rather than a level.
+EVENT_METRICS = {'crit'}
+ALERT_RULE_RE = re.compile(r'^(?:(?P<host>[^:]+):)?(?P<metric>\w+)(?P<op>>=|<=)(?P<fire>[\d.]+)(?:/(?P<clear>[\d.]+))?$')
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_ADDRESS = os.getenv('METRICS_ADDRESS', '127.0.0.1')
+METRICS_READ_TIMEOUT = 10
+PROFILE_SECONDS = int(os.getenv('PROFILE_SECONDS', '30'))
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', '40'))
+CHART_WIDTH = int(os.getenv('CHART_WIDTH', '40'))
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', '64'))
+SPARKLINE_BARS = '▁▂▃▄▅▆▇█'
+REPL_STATUS_TTL = float(os.getenv('REPL_STATUS_TTL', '5'))
+REPLICATION_QUERY = '''
+SELECT application_name, client_addr, state, sync_state,
+       pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn) AS lag_bytes,
+       EXTRACT(EPOCH FROM replay_lag) AS lag_seconds
+FROM pg_stat_replication
+'''
+WAL_RECEIVER_QUERY = '''
+SELECT status, sender_host, sender_port,
+       pg_wal_lsn_diff(latest_end_lsn, pg_last_wal_replay_lsn()) AS lag_bytes,
+       EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) AS lag_seconds
+FROM pg_stat_wal_receiver
+'''
+
+metrics = {}
+persistent_clients = {}
+persistent_lock = threading.Lock()
+ssh_sessions = threading.BoundedSemaphore(SSH_MAX_SESSIONS)
+cpu_counters = {}
+journal_cursors = {}
+chart_cache = OrderedDict()
+repl_status_cache = {}
+alert_subscribers = None
+phase_stats = {}
+error_counts = {}
+output_sizes = {}
+output_estimates = {}
+command_cache = {}
+snapshots = {}
+gzip_stats = {'enabled': True, 'commands': 0, 'raw_bytes': 0, 'wire_bytes': 0}
+cache_stats = {}
+metrics_server = None
+schema_task = None
+commands_task = None
+profile_state = {'profiler': None, 'chat_id': None, 'updates': None}
+rate_buckets = {}
+limiter_stats = {'allowed': {}, 'rejected': {}, 'send_waits': 0, 'send_wait_seconds': 0.0}
+pending_users = OrderedDict()
+current_request = ContextVar('current_request', default=None)
+current_cancel = ContextVar('current_cancel', default=None)
+running_commands = {}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+@contextmanager
+def span(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        error_counts[phase] = error_counts.get(phase, 0) + 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        phase_stats.setdefault(phase, Histogram()).observe(elapsed)
+        request = current_request.get()
+        if request is not None:
+            request['phases'][phase] = request['phases'].get(phase, 0) + elapsed * 1000
+
+def record_size(name, size):
+    output_sizes.setdefault(name, Histogram((1024, 4096, 16384, 65536, 262144, 1048576, 4194304))).observe(size)
+    request = current_request.get()
+    if request is not None:
+        request['bytes'] = request.get('bytes', 0) + size
+
+def record_cache(name, hit):
+    stats = cache_stats.setdefault(name, {'hit': 0, 'miss': 0})
+    stats['hit' if hit else 'miss'] += 1
+
+def instrumented(callback):
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: CallbackContext):
+        request = {'handler': callback.__name__, 'phases': {}}
+        if update.effective_user:
+            request['user'] = update.effective_user.id
+        if update.effective_chat:
+            request['chat'] = update.effective_chat.id
+        token = current_request.set(request)
+        cancel = threading.Event()
+        cancel_token = current_cancel.set(cancel)
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        running_commands.setdefault(chat_id, set()).add(cancel)
+        start = time.perf_counter()
+        try:
+            with span(f'handler:{callback.__name__}'):
+                return await callback(update, context)
+        except Exception as e:
+            request['error'] = type(e).__name__
+            raise
+        finally:
+            # Also stops a worker thread left behind by a cancelled handler.
+            cancel.set()
+            running_commands[chat_id].discard(cancel)
+            if not running_commands[chat_id]:
+                del running_commands[chat_id]
+            current_cancel.reset(cancel_token)
+            request['duration_ms'] = round((time.perf_counter() - start) * 1000, 1)
+            request['phases'] = {phase: round(ms, 1) for phase, ms in request['phases'].items()
+                                 if not phase.startswith('handler:')}
+            current_request.reset(token)
+            logger.info('request %s', json.dumps(request, ensure_ascii=False))
+            if profile_state['updates'] is not None and callback.__name__ != 'profile':
+                profile_state['updates'] -= 1
+                if profile_state['updates'] <= 0:
+                    context.application.create_task(finish_profile(context.application))
+    return wrapper
+
+def start_profile(application, chat_id=None, seconds=None, updates=None):
+    profiler = cProfile.Profile()
+    profile_state.update(profiler=profiler, chat_id=chat_id, updates=updates)
+    profiler.enable()
+    if seconds:
+        def stop():
+            if profile_state['profiler'] is profiler:
+                application.create_task(finish_profile(application))
+        asyncio.get_running_loop().call_later(seconds, stop)
+
+async def finish_profile(application, chat_id=None) -> None:
+    # chat_id overrides where the report goes, so /profile stop on a run
+    # started with SIGUSR1 sends it to the admin instead of a file.
+    profiler = profile_state['profiler']
+    chat_id = chat_id or profile_state['chat_id']
+    if profiler is None:
+        return
+    profiler.disable()
+    profile_state.update(profiler=None, chat_id=None, updates=None)
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    report = stream.getvalue()
+    if chat_id is None:
+        path = f'profile-{time.strftime("%Y%m%d-%H%M%S")}.txt'
+        with open(path, 'w') as f:
+            f.write(report)
+        logger.info('Profile written to %s', path)
+    else:
+        await application.bot.send_document(chat_id, document=report.encode(), filename='profile.txt')
+
+def toggle_profile(application):
+    if profile_state['profiler'] is None:
+        logger.info('Profiling for %s seconds', PROFILE_SECONDS)
+        start_profile(application, seconds=PROFILE_SECONDS)
+    else:
+        application.create_task(finish_profile(application))
+
+def prometheus_histogram(name, labels, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+    return lines
+
+def render_prometheus():
+    lines = [
+        '# TYPE ptbot_handler_duration_seconds histogram',
+        '# TYPE ptbot_phase_duration_seconds histogram',
+    ]
+    for phase, histogram in sorted(phase_stats.items()):
+        if phase.startswith('handler:'):
+            lines += prometheus_histogram('ptbot_handler_duration_seconds', f'handler="{phase[8:]}"', histogram)
+        else:
+            lines += prometheus_histogram('ptbot_phase_duration_seconds', f'phase="{phase}"', histogram)
+    lines.append('# TYPE ptbot_errors_total counter')
+    for phase, count in sorted(error_counts.items()):
+        lines.append(f'ptbot_errors_total{{phase="{phase}"}} {count}')
+    lines.append('# TYPE ptbot_output_bytes histogram')
+    for name, histogram in sorted(output_sizes.items()):
+        lines += prometheus_histogram('ptbot_output_bytes', f'source="{name}"', histogram)
+    lines.append('# TYPE ptbot_cache_requests_total counter')
+    for name, stats in sorted(cache_stats.items()):
+        for result, count in stats.items():
+            lines.append(f'ptbot_cache_requests_total{{cache="{name}",result="{result}"}} {count}')
+    lines.append('# TYPE ptbot_rate_limit_requests_total counter')
+    for result in ('allowed', 'rejected'):
+        for cost_class, count in sorted(limiter_stats[result].items()):
+            lines.append(f'ptbot_rate_limit_requests_total{{cost="{cost_class}",result="{result}"}} {count}')
+    lines.append('# TYPE ptbot_send_wait_seconds_total counter')
+    lines.append(f'ptbot_send_wait_seconds_total {limiter_stats["send_wait_seconds"]}')
+    lines.append('# TYPE ptbot_ssh_gzip_bytes_total counter')
+    lines.append(f'ptbot_ssh_gzip_bytes_total{{side="raw"}} {gzip_stats["raw_bytes"]}')
+    lines.append(f'ptbot_ssh_gzip_bytes_total{{side="wire"}} {gzip_stats["wire_bytes"]}')
+    lines.append('# TYPE ptbot_send_queue_depth gauge')
+    lines.append(f'ptbot_send_queue_depth {send_queue.depth()}')
+    lines.append('# TYPE ptbot_send_queue_messages_total counter')
+    lines.append(f'ptbot_send_queue_messages_total{{result="sent"}} {send_queue.sent}')
+    lines.append(f'ptbot_send_queue_messages_total{{result="coalesced"}} {send_queue.coalesced}')
+    lines.append(f'ptbot_send_queue_messages_total{{result="retry_after"}} {send_queue.retries}')
+    lines.append('# TYPE ptbot_ssh_persistent_connections gauge')
+    lines.append(f'ptbot_ssh_persistent_connections {len(persistent_clients)}')
+    return '\n'.join(lines) + '\n'
+
+async def read_request_line(reader):
+    request_line = await reader.readline()
+    while (await reader.readline()).strip():
+        pass
+    return request_line
+
+async def serve_metrics(reader, writer):
+    try:
+        # A client that never finishes its headers is dropped instead of
+        # holding the socket and this coroutine forever.
+        request_line = await asyncio.wait_for(read_request_line(reader), METRICS_READ_TIMEOUT)
+        if request_line.split()[1:2] == [b'/metrics']:
+            status, body = '200 OK', render_prometheus().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (ConnectionError, IndexError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+def create_schema():
+    import db
+    db.init_schema()
+
+async def init_schema() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(create_schema)
+            logger.info('Database schema is ready')
+            return
+        except Exception as e:
+            logger.warning('Database schema check failed, retrying in %s s: %s', DB_RETRY_INTERVAL, e)
+            await asyncio.sleep(DB_RETRY_INTERVAL)
+
+async def post_init(application: Application) -> None:
+    global metrics_server, schema_task, commands_task
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=WORKER_THREADS))
+    schema_task = asyncio.create_task(init_schema())
+    commands_task = asyncio.create_task(publish_commands(application))
+    pending_users.update((user_id, None) for user_id in application.user_data)
+    if METRICS_PORT:
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_ADDRESS, METRICS_PORT)
+        logger.info('Serving metrics on %s:%s', METRICS_ADDRESS, METRICS_PORT)
+    if hasattr(signal, 'SIGUSR1'):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_profile, application)
+
+async def post_shutdown(application: Application) -> None:
+    if schema_task is not None:
+        schema_task.cancel()
+    if commands_task is not None:
+        commands_task.cancel()
+    if metrics_server is not None:
+        metrics_server.close()
+    drop_persistent_client()
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Updates from different chats run concurrently, updates from one chat run
+    # in arrival order, except /cancel. The chat lock is taken before a concurrency slot so a
+    # busy chat does not hold slots that other chats could use.
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.chat_locks = {}
+
+    async def process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        # /cancel must not wait behind the command it is meant to stop.
+        if chat is None or command_name(update) == 'cancel':
+            await super().process_update(update, coroutine)
+            return
+        lock, waiting = self.chat_locks.get(chat.id, (asyncio.Lock(), 0))
+        self.chat_locks[chat.id] = (lock, waiting + 1)
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            lock, waiting = self.chat_locks[chat.id]
+            if waiting == 1:
+                del self.chat_locks[chat.id]
+            else:
+                self.chat_locks[chat.id] = (lock, waiting - 1)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.warned = False
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount=1):
+        self.refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        self.warned = False
+        return True
+
+    async def acquire(self, amount=1):
+        # Reserve first and sleep off the debt, so concurrent callers are
+        # spaced out instead of all waking up at the same moment.
+        self.refill()
+        self.tokens -= amount
+        if self.tokens < 0:
+            delay = -self.tokens / self.rate
+            await asyncio.sleep(delay)
+            return delay
+        return 0
+
+def parse_rate(spec):
+    rate, capacity = spec.split(':')
+    return float(rate), float(capacity)
+
+def prune_buckets():
+    for key, bucket in list(rate_buckets.items()):
+        bucket.refill()
+        if bucket.tokens >= bucket.capacity:
+            del rate_buckets[key]
+
+def get_bucket(key, spec):
+    bucket = rate_buckets.get(key)
+    if bucket is None:
+        if len(rate_buckets) > 10000:
+            prune_buckets()
+        bucket = rate_buckets[key] = TokenBucket(*parse_rate(spec))
+    return bucket
+
+def command_name(update):
+    text = update.message.text if update.message and update.message.text else ''
+    return text.split()[0][1:].split('@')[0] if text.startswith('/') else ''
+
+def command_cost(update):
+    return COMMAND_COSTS.get(command_name(update), 'cheap')
+
+async def rate_limit(update: Update, context: CallbackContext) -> None:
+    if update.effective_user is None or update.effective_chat is None:
+        return
+    cost_class = command_cost(update)
+    user_bucket = get_bucket(('user', update.effective_user.id, cost_class), RATE_LIMITS[cost_class])
+    chat_bucket = get_bucket(('chat', update.effective_chat.id, cost_class), RATE_LIMITS[cost_class])
+    if user_bucket.take():
+        if chat_bucket.take():
+            limiter_stats['allowed'][cost_class] = limiter_stats['allowed'].get(cost_class, 0) + 1
+            return
+        user_bucket.tokens += 1
+    limiter_stats['rejected'][cost_class] = limiter_stats['rejected'].get(cost_class, 0) + 1
+    bucket = user_bucket if user_bucket.tokens < 1 else chat_bucket
+    if not bucket.warned and update.message:
+        bucket.warned = True
+        await update.message.reply_text(f'Слишком много запросов, подождите {(1 - bucket.tokens) / bucket.rate:.0f} с.')
+    raise ApplicationHandlerStop
+
+send_bucket = TokenBucket(RATE_LIMIT_SENDS, RATE_LIMIT_SENDS)
+
+def paginate(text, limit=MESSAGE_LIMIT):
+    pages = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        pages.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    pages.append(text)
+    return pages
+
+class SendQueue:
+    # One drain task per chat with pending messages. Consecutive messages that
+    # fit into one Telegram message are merged, each chat is paced by its own
+    # bucket and a RetryAfter pauses every chat for the requested time.
+    def __init__(self):
+        self.chats = {}
+        self.workers = {}
+        self.paused_until = 0.0
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+
+    def depth(self):
+        return sum(len(queue) for queue in self.chats.values())
+
+    def send(self, bot, chat_id, text):
+        future = asyncio.get_running_loop().create_future()
+        self.chats.setdefault(chat_id, deque()).append((text, future))
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self.drain(bot, chat_id))
+        return future
+
+    async def drain(self, bot, chat_id):
+        queue = self.chats[chat_id]
+        try:
+            while queue:
+                text, future = queue.popleft()
+                batch = [future]
+                while queue and len(text) + 1 + len(queue[0][0]) <= MESSAGE_LIMIT:
+                    next_text, next_future = queue.popleft()
+                    text += '\n' + next_text
+                    batch.append(next_future)
+                self.coalesced += len(batch) - 1
+                await get_bucket(('send', chat_id), RATE_LIMIT_CHAT_SENDS).acquire()
+                try:
+                    result = await self.deliver(bot, chat_id, text)
+                except Exception as e:
+                    logger.warning('Delivery to %s failed: %s', chat_id, e)
+                    for future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                            future.exception()
+                else:
+                    # A waiter may have been cancelled meanwhile (a handler
+                    # stopped by /cancel), its message is still delivered.
+                    for future in batch:
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            del self.workers[chat_id]
+            if not queue:
+                del self.chats[chat_id]
+
+    async def deliver(self, bot, chat_id, text):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                result = await bot.send_message(chat_id, text)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                self.retries += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+
+send_queue = SendQueue()
+
+async def reply_long(update: Update, text: str) -> None:
+    if not text.strip():
+        text = 'Пустой вывод.'
+    bot = update.get_bot()
+    await asyncio.gather(*[send_queue.send(bot, update.effective_chat.id, page) for page in paginate(text)])
+
+class ChatStream:
+    # Forwards command output while the command still runs: full pages go out
+    # as soon as they fill up and complete lines are flushed at least every
+    # SSH_STREAM_INTERVAL seconds. on_chunk is called from the worker thread.
+    def __init__(self, update, header=''):
+        self.bot = update.get_bot()
+        self.chat_id = update.effective_chat.id
+        self.loop = asyncio.get_running_loop()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.buffer = header
+        self.flushed = time.monotonic()
+        self.futures = []
+
+    def on_chunk(self, chunk):
+        self.loop.call_soon_threadsafe(self.feed, self.decoder.decode(chunk))
+
+    def feed(self, text):
+        pages = paginate(self.buffer + text)
+        self.buffer = pages.pop()
+        cut = self.buffer.rfind('\n')
+        if cut > 0 and time.monotonic() - self.flushed >= SSH_STREAM_INTERVAL:
+            pages.append(self.buffer[:cut])
+            self.buffer = self.buffer[cut + 1:]
+        if pages:
+            self.flushed = time.monotonic()
+        for page in pages:
+            self.futures.append(send_queue.send(self.bot, self.chat_id, page))
+
+    async def finish(self, error, notice):
+        text = self.buffer + self.decoder.decode(b'', final=True)
+        if error:
+            text = f'{text}\n{error}' if self.futures else error
+        text += notice
+        if text.strip() or not self.futures:
+            for page in paginate(text if text.strip() else 'Пустой вывод.'):
+                self.futures.append(send_queue.send(self.bot, self.chat_id, page))
+        await asyncio.gather(*self.futures)
+
+async def stream_reply(update: Update, command, header='', timeout=None):
+    stream = ChatStream(update, header)
+    output, error, notice = await asyncio.to_thread(run_streaming, command, stream.on_chunk, timeout)
+    await stream.finish(error, notice)
+    return output, error, notice
+
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url, *args, **kwargs):
+        if url.rsplit('/', 1)[-1].startswith(SEND_METHODS):
+            delay = await send_bucket.acquire()
+            if delay:
+                limiter_stats['send_waits'] += 1
+                limiter_stats['send_wait_seconds'] += delay
+        with span('telegram_api'):
+            return await super().do_request(url, *args, **kwargs)
 
 def connect_to_server():
+    import paramiko
     ssh_host = os.getenv('SSH_HOST')
+    if not ssh_host:
+        raise ValueError('SSH_HOST is not set; to run commands on this machine set it and list it in LOCAL_HOSTS')
     ssh_port = int(os.getenv('SSH_PORT'))
     ssh_username = os.getenv('SSH_USERNAME')
     ssh_password = os.getenv('SSH_PASSWORD')
 
     ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh_client.connect(hostname=ssh_host, port=ssh_port, username=ssh_username, password=ssh_password)
+    if SSH_HOST_KEY_POLICY == 'auto':
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    else:
+        # Known keys come from the system known_hosts and SSH_KNOWN_HOSTS. With
+        # 'tofu' an unknown host is trusted once and its key saved to
+        # SSH_KNOWN_HOSTS, so a changed key is rejected from then on. 'strict'
+        # only accepts keys that are already listed.
+        ssh_client.load_system_host_keys()
+        if SSH_HOST_KEY_POLICY == 'tofu':
+            os.makedirs(os.path.dirname(SSH_KNOWN_HOSTS) or '.', mode=0o700, exist_ok=True)
+            open(SSH_KNOWN_HOSTS, 'a').close()
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        else:
+            ssh_client.set_missing_host_key_policy(paramiko.RejectPolicy())
+        if os.path.exists(SSH_KNOWN_HOSTS):
+            ssh_client.load_host_keys(SSH_KNOWN_HOSTS)
+    with span('ssh_connect'):
+        ssh_client.connect(hostname=ssh_host, port=ssh_port, username=ssh_username, password=ssh_password,
+                           key_filename=SSH_KEY_FILE, passphrase=SSH_KEY_PASSPHRASE,
+                           # With a password, offering every agent or default key first can
+                           # hit sshd's MaxAuthTries before the password is tried.
+                           allow_agent=SSH_USE_AGENT and not ssh_password,
+                           look_for_keys=not ssh_password and not SSH_KEY_FILE, compress=SSH_COMPRESS,
+                           timeout=SSH_CONNECT_TIMEOUT, banner_timeout=SSH_CONNECT_TIMEOUT,
+                           auth_timeout=SSH_CONNECT_TIMEOUT)
+    ssh_client.get_transport().set_keepalive(SSH_KEEPALIVE)
 
     return ssh_client
 
 
-def execute_command(ssh_client, command):
-    stdin, stdout, stderr = ssh_client.exec_command(command)
-    output = stdout.read().decode('utf-8')
-    error = stderr.read().decode('utf-8')
+def stream_command(ssh_client, command, on_chunk=None, timeout=None):
+    # stdout and stderr are drained together as data arrives, so a command
+    # that fills the stderr window cannot stall while stdout is being read.
+    # Commands whose last output reached SSH_GZIP_THRESHOLD have stdout piped
+    # through gzip and inflated here chunk by chunk.
+    compressed = (SSH_GZIP_THRESHOLD > 0 and gzip_stats['enabled']
+                  and output_estimates.get(command, 0) >= SSH_GZIP_THRESHOLD)
+    decompressor = zlib.decompressobj(wbits=31) if compressed else None
+    timeout = timeout or SSH_COMMAND_TIMEOUT
+    remote = command
+    if SSH_REMOTE_TIMEOUT:
+        # The remote side kills the command itself, closing the channel here
+        # does not stop a process stuck on a dead mount.
+        remote = f'timeout -k 5 {timeout:g} sh -c {shlex.quote(command)}'
+    if compressed:
+        remote = f'{{ {remote}; }} | gzip -1 -c'
+    # sshd starts the command's shell as a session leader, its pid names the
+    # session that holds every process of the command (timeout moves to a
+    # group of its own, not a session), so a cut run can be killed remotely.
+    remote = f'echo "{SESSION_MARKER}$$" >&2; {remote}'
+    cancel = current_cancel.get()
+    # At most SSH_MAX_SESSIONS channels are open at once on the shared
+    # connection, sshd refuses sessions beyond its MaxSessions.
+    with ssh_sessions:
+        with span('ssh_exec'):
+            channel = ssh_client.get_transport().open_session(timeout=SSH_EXEC_TIMEOUT)
+            channel.exec_command(remote)
+        output, error = bytearray(), bytearray()
+        wire = 0
+        notice = ''
+        deadline = time.monotonic() + timeout
+        try:
+            with span('ssh_read'):
+                while True:
+                    if cancel is not None and cancel.is_set():
+                        notice = '\n[Команда отменена]'
+                        break
+                    if channel.recv_stderr_ready():
+                        error += channel.recv_stderr(SSH_CHUNK_SIZE)
+                    elif channel.recv_ready():
+                        chunk = channel.recv(SSH_CHUNK_SIZE)
+                        wire += len(chunk)
+                        if decompressor is not None:
+                            chunk = decompressor.decompress(chunk, SSH_MAX_OUTPUT + 1 - len(output))
+                        output += chunk
+                        if on_chunk is not None:
+                            on_chunk(chunk)
+                    elif channel.eof_received or channel.closed:
+                        break
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            notice = f'\n[Вывод прерван: команда не завершилась за {timeout:g} с]'
+                            break
+                        select.select([channel], [], [], min(remaining, 0.25))
+                    if len(output) + len(error) > SSH_MAX_OUTPUT:
+                        notice = f'\n[Вывод обрезан: больше {SSH_MAX_OUTPUT} байт]'
+                        del output[SSH_MAX_OUTPUT:]
+                        break
+        except zlib.error as e:
+            # What was inflated so far is only a prefix of the output.
+            notice = '\n[Вывод повреждён: не удалось распаковать сжатый поток]'
+            decompressor = None
+            gzip_stats['enabled'] = False
+            logger.warning('Remote gzip output is unreadable, disabling compression: %s', e)
+        finally:
+            if notice and not error.startswith(SESSION_MARKER.encode()) and channel.recv_stderr_ready():
+                error += channel.recv_stderr(SSH_CHUNK_SIZE)
+            channel.close()
+    session = None
+    if error.startswith(SESSION_MARKER.encode()):
+        line, _, rest = error.partition(b'\n')
+        session = line[len(SESSION_MARKER):].decode()
+        error = rest
+    if notice and session and session.isdigit():
+        kill_remote_session(ssh_client, session)
+    if decompressor is not None:
+        gzip_stats['commands'] += 1
+        gzip_stats['raw_bytes'] += len(output)
+        gzip_stats['wire_bytes'] += wire
+        if not decompressor.eof and not notice:
+            notice = '\n[Вывод повреждён: сжатый поток оборвался]'
+            gzip_stats['enabled'] = False
+            logger.warning('Remote gzip produced no complete stream, disabling compression: %s', error.decode(errors='replace'))
+    output_estimates[command] = len(output)
+    record_size('ssh_output', len(output) + len(error))
+    return output.decode('utf-8', errors='replace'), error.decode('utf-8', errors='replace'), notice
+
+def kill_remote_session(ssh_client, session):
+    # Stops what is left of a cancelled, timed out or cut command instead of
+    # letting it run until the remote timeout.
+    try:
+        with ssh_sessions:
+            channel = ssh_client.get_transport().open_session(timeout=SSH_EXEC_TIMEOUT)
+            try:
+                channel.exec_command(f'pkill -TERM -s {session}')
+                channel.status_event.wait(SSH_EXEC_TIMEOUT)
+            finally:
+                channel.close()
+    except Exception as e:
+        logger.warning('Could not stop remote session %s: %s', session, e)
+
+def stream_local(command, on_chunk=None, timeout=None):
+    # Same contract as stream_command for a host listed in LOCAL_HOSTS: the
+    # command runs here in its own process group, which is killed on timeout,
+    # cancel or when the output cap is hit.
+    timeout = timeout or SSH_COMMAND_TIMEOUT
+    cancel = current_cancel.get()
+    with span('local_exec'):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, start_new_session=True)
+    output, error = bytearray(), bytearray()
+    buffers = {process.stdout: output, process.stderr: error}
+    notice = ''
+    deadline = time.monotonic() + timeout
+    try:
+        with span('local_read'):
+            while buffers:
+                if cancel is not None and cancel.is_set():
+                    notice = '\n[Команда отменена]'
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    notice = f'\n[Вывод прерван: команда не завершилась за {timeout:g} с]'
+                    break
+                ready, _, _ = select.select(list(buffers), [], [], min(remaining, 0.25))
+                for stream in ready:
+                    chunk = os.read(stream.fileno(), SSH_CHUNK_SIZE)
+                    if not chunk:
+                        del buffers[stream]
+                        continue
+                    buffers[stream] += chunk
+                    if stream is process.stdout and on_chunk is not None:
+                        on_chunk(chunk)
+                if len(output) + len(error) > SSH_MAX_OUTPUT:
+                    notice = f'\n[Вывод обрезан: больше {SSH_MAX_OUTPUT} байт]'
+                    del output[SSH_MAX_OUTPUT:]
+                    break
+    finally:
+        if process.poll() is None:
+            os.killpg(process.pid, signal.SIGKILL)
+        process.stdout.close()
+        process.stderr.close()
+        process.wait()
+    record_size('local_output', len(output) + len(error))
+    return output.decode('utf-8', errors='replace'), error.decode('utf-8', errors='replace'), notice
+
+def is_local_host(host):
+    # Only hosts listed explicitly, an unset SSH_HOST must not fall back to
+    # running sudo commands on the bot machine.
+    return bool(host) and host in LOCAL_HOSTS
 
+def execute_command(ssh_client, command, timeout=None):
+    output, error, notice = stream_command(ssh_client, command, timeout=timeout)
     if error:
-        return error
+        return error + notice
     else:
-        return output
+        return output + notice
+
+def run_command(command, timeout=None):
+    if is_local_host(os.getenv('SSH_HOST')):
+        output, error, notice = stream_local(command, timeout=timeout)
+        return (error or output) + notice
+    return execute_command(get_persistent_client(), command, timeout)
+
+def run_streaming(command, on_chunk, timeout=None):
+    if is_local_host(os.getenv('SSH_HOST')):
+        return stream_local(command, on_chunk, timeout)
+    return stream_command(get_persistent_client(), command, on_chunk, timeout)
+
+def read_proc_files(paths):
+    # Reads several /proc files in one go: directly when the host is local,
+    # otherwise with a single remote tail whose per-file headers split the
+    # output. 'statfs' stands for the block counts of / from statvfs.
+    if is_local_host(os.getenv('SSH_HOST')):
+        files = {}
+        for path in paths:
+            if path == 'statfs':
+                stat = os.statvfs('/')
+                files[path] = f'{stat.f_blocks} {stat.f_bfree} {stat.f_bavail} {stat.f_frsize}\n'
+                continue
+            try:
+                with open(path) as f:
+                    files[path] = f.read()
+            except OSError:
+                files[path] = ''
+        return files
+    command = 'tail -v -n +1 -- ' + ' '.join(path for path in paths if path != 'statfs') + ' 2>/dev/null'
+    if 'statfs' in paths:
+        command += "; echo '==> statfs <=='; stat -f -c '%b %f %a %S' /"
+    files = {path: [] for path in paths}
+    path = None
+    for line in run_command(command).splitlines():
+        match = PROC_HEADER_RE.fullmatch(line)
+        if match:
+            path = match[1]
+            files[path] = []
+        elif path is not None:
+            files[path].append(line)
+    return {path: '\n'.join(lines).strip('\n') + '\n' for path, lines in files.items()}
+
+def parse_meminfo(text):
+    meminfo = {}
+    for line in text.splitlines():
+        key, value = line.split(':', 1)
+        meminfo[key] = int(value.split()[0])
+    return meminfo
+
+def cpu_usage(host, line):
+    counters = [int(value) for value in line.split()[1:]]
+    idle = counters[3] + (counters[4] if len(counters) > 4 else 0)
+    total = sum(counters[:8])
+    previous = cpu_counters.get(host)
+    cpu_counters[host] = (idle, total)
+    if previous is not None and total > previous[1]:
+        return 100.0 * (1 - (idle - previous[0]) / (total - previous[1]))
+    return None
+
+def proc_metrics_sample(files, host):
+    sample = {'load': float(files['/proc/loadavg'].split()[0])}
+    meminfo = parse_meminfo(files['/proc/meminfo'])
+    sample['mem'] = 100.0 * (meminfo['MemTotal'] - meminfo['MemAvailable']) / meminfo['MemTotal']
+    blocks, free, available, _ = (int(value) for value in files['statfs'].split())
+    sample['disk'] = 100.0 * (blocks - free) / max(blocks - free + available, 1)
+    cpu = cpu_usage(host, files['/proc/stat'].splitlines()[0])
+    if cpu is not None:
+        sample['cpu'] = cpu
+    return sample
+
+def human_size(kilobytes):
+    if not kilobytes:
+        return '0B'
+    size = float(kilobytes)
+    for unit in ('Ki', 'Mi', 'Gi', 'Ti'):
+        if size < 1024 or unit == 'Ti':
+            return f'{size:.1f}{unit}' if size < 10 else f'{size:.0f}{unit}'
+        size /= 1024
+
+def render_uptime(files):
+    seconds = int(float(files['/proc/uptime'].split()[0]))
+    load = files['/proc/loadavg'].split()[:3]
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    return f'up {days} days, {hours:02d}:{seconds // 60:02d}, load average: {", ".join(load)}\n'
+
+def render_free(files):
+    meminfo = parse_meminfo(files['/proc/meminfo'])
+    cache = meminfo.get('Buffers', 0) + meminfo.get('Cached', 0) + meminfo.get('SReclaimable', 0)
+    # procps-ng 4 counts used memory as total minus available.
+    used = meminfo['MemTotal'] - meminfo.get('MemAvailable', meminfo['MemFree'] + cache)
+    swap_used = meminfo.get('SwapTotal', 0) - meminfo.get('SwapFree', 0)
+    rows = [
+        ('', 'total', 'used', 'free', 'shared', 'buff/cache', 'available'),
+        ('Mem:',) + tuple(human_size(value) for value in (meminfo['MemTotal'], used, meminfo['MemFree'],
+                                                          meminfo.get('Shmem', 0), cache, meminfo['MemAvailable'])),
+        ('Swap:',) + tuple(human_size(value) for value in (meminfo.get('SwapTotal', 0), swap_used,
+                                                           meminfo.get('SwapFree', 0))),
+    ]
+    return '\n'.join(f'{row[0]:<8}' + ''.join(f'{cell:>12}' for cell in row[1:]) for row in rows) + '\n'
+
+def render_mpstat(files):
+    columns = ('%usr', '%nice', '%sys', '%iowait', '%irq', '%soft', '%steal', '%idle')
+    lines = ['CPU    ' + ''.join(f'{column:>9}' for column in columns)]
+    for line in files['/proc/stat'].splitlines():
+        if not line.startswith('cpu'):
+            break
+        name, *values = line.split()
+        user, nice, system, idle, iowait, irq, softirq, steal = (int(value) for value in values[:8])
+        total = max(user + nice + system + idle + iowait + irq + softirq + steal, 1)
+        shares = (user, nice, system, iowait, irq, softirq, steal, idle)
+        label = 'all' if name == 'cpu' else name[3:]
+        lines.append(f'{label:<7}' + ''.join(f'{100 * share / total:>9.2f}' for share in shares))
+    return '\n'.join(lines) + '\n'
+
+def proc_address(value):
+    address, port = value.split(':')
+    raw = bytes.fromhex(address)
+    if len(raw) == 4:
+        host = socket.inet_ntop(socket.AF_INET, raw[::-1])
+    else:
+        host = '[' + socket.inet_ntop(socket.AF_INET6, b''.join(raw[i:i + 4][::-1] for i in range(0, 16, 4))) + ']'
+    port = int(port, 16)
+    return f'{host}:{port if port else "*"}'
+
+def render_sockets(files):
+    # ss -tuna from /proc/net, without the process column that needs root.
+    lines = [f'{"Netid":<6}{"State":<11}{"Recv-Q":>7}{"Send-Q":>7}  {"Local Address:Port":<46}Peer Address:Port']
+    for path in SOCKET_PROC_FILES:
+        netid = 'tcp' if 'tcp' in path else 'udp'
+        for line in files.get(path, '').splitlines()[1:]:
+            parts = line.split()
+            if len(parts) < 5:
+                continue
+            state = TCP_STATES.get(parts[3], parts[3])
+            send, receive = (int(value, 16) for value in parts[4].split(':'))
+            lines.append(f'{netid:<6}{state:<11}{receive:>7}{send:>7}  {proc_address(parts[1]):<46}'
+                         f'{proc_address(parts[2])}')
+    return '\n'.join(lines) + '\n'
+
+def get_persistent_client():
+    # Every command opens a channel on one long-lived authenticated transport
+    # instead of paying for a TCP, key exchange and auth handshake each time.
+    host = os.getenv('SSH_HOST')
+    with persistent_lock:
+        ssh_client = persistent_clients.get(host)
+        if ssh_client is not None:
+            transport = ssh_client.get_transport()
+            if transport is not None and transport.is_active():
+                return ssh_client
+            ssh_client.close()
+        ssh_client = connect_to_server()
+        persistent_clients[host] = ssh_client
+        return ssh_client
+
+def drop_persistent_client():
+    with persistent_lock:
+        ssh_client = persistent_clients.pop(os.getenv('SSH_HOST'), None)
+    if ssh_client is not None:
+        ssh_client.close()
+
+class RingBuffer:
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', [0.0]) * size
+        self.values = array('d', [0.0]) * size
+        self.index = 0
+        self.count = 0
+
+    def append(self, timestamp, value):
+        self.times[self.index] = timestamp
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def oldest(self):
+        if not self.count:
+            return None
+        return self.times[(self.index - self.count) % self.size]
+
+    def since(self, start):
+        points = []
+        for i in range(1, self.count + 1):
+            position = (self.index - i) % self.size
+            if self.times[position] < start:
+                break
+            points.append((self.times[position], self.values[position]))
+        points.reverse()
+        return points
+
+class MetricSeries:
+    def __init__(self):
+        self.raw = RingBuffer(METRICS_HISTORY)
+        self.rollup_avg = RingBuffer(METRICS_ROLLUP_HISTORY)
+        self.rollup_min = RingBuffer(METRICS_ROLLUP_HISTORY)
+        self.rollup_max = RingBuffer(METRICS_ROLLUP_HISTORY)
+        self.pending = []
+        self.version = 0
+
+    def add(self, timestamp, value):
+        self.version += 1
+        self.raw.append(timestamp, value)
+        self.pending.append(value)
+        if len(self.pending) >= METRICS_ROLLUP:
+            self.rollup_avg.append(timestamp, sum(self.pending) / len(self.pending))
+            self.rollup_min.append(timestamp, min(self.pending))
+            self.rollup_max.append(timestamp, max(self.pending))
+            self.pending = []
+
+    def points(self, seconds):
+        start = time.time() - seconds
+        if self.raw.count == self.raw.size and self.raw.oldest() > start:
+            return self.rollup_avg.since(start)
+        return self.raw.since(start)
+
+    def summary(self, seconds):
+        start = time.time() - seconds
+        oldest = self.raw.oldest()
+        if oldest is None:
+            return None
+        averages = []
+        if self.raw.count == self.raw.size and oldest > start:
+            averages = [value for _, value in self.rollup_avg.since(start)]
+        if averages:
+            low = min(value for _, value in self.rollup_min.since(start))
+            high = max(value for _, value in self.rollup_max.since(start))
+        else:
+            averages = [value for _, value in self.raw.since(start)]
+            if not averages:
+                return None
+            low, high = min(averages), max(averages)
+        last = self.raw.values[(self.raw.index - 1) % self.raw.size]
+        return {'min': low, 'avg': sum(averages) / len(averages), 'max': high, 'last': last, 'points': len(averages)}
+
+def parse_metrics_sample(output, host):
+    lines = output.splitlines()
+    sample = {'load': float(lines[0].split()[0])}
+
+    meminfo = {}
+    for line in lines[1:3]:
+        key, value = line.split(':', 1)
+        meminfo[key] = int(value.split()[0])
+    sample['mem'] = 100.0 * (meminfo['MemTotal'] - meminfo['MemAvailable']) / meminfo['MemTotal']
+
+    sample['disk'] = float(lines[3].split()[4].rstrip('%'))
+
+    cpu = cpu_usage(host, lines[4])
+    if cpu is not None:
+        sample['cpu'] = cpu
+    return sample
+
+def sample_metrics():
+    host = os.getenv('SSH_HOST')
+    if PROBE_MODE == 'proc' or is_local_host(host):
+        return host, proc_metrics_sample(read_proc_files(METRICS_PROC_FILES), host)
+    output = execute_command(get_persistent_client(), METRICS_COMMAND)
+    return host, parse_metrics_sample(output, host)
+
+async def collect_metrics(context: CallbackContext) -> None:
+    try:
+        host, sample = await asyncio.to_thread(sample_metrics)
+    except Exception as e:
+        logger.warning('Metrics sample failed: %s', e)
+        return
+    timestamp = time.time()
+    for name, value in sample.items():
+        metrics.setdefault((host, name), MetricSeries()).add(timestamp, value)
+    await process_alerts(context, host, sample)
+
+def parse_window(args, default=3600):
+    if not args:
+        return default
+    value = args[0].lower()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value) * 60
+
+async def reply_history(update: Update, name: str, args) -> None:
+    try:
+        seconds = parse_window(args)
+    except ValueError:
+        await update.message.reply_text('Неверный период. Примеры: 30m, 1h, 1d.')
+        return
+    series = metrics.get((os.getenv('SSH_HOST'), name))
+    summary = series.summary(seconds) if series else None
+    if summary is None:
+        await update.message.reply_text('Нет собранных данных за этот период.')
+        return
+    await update.message.reply_text(
+        f'{METRIC_LABELS[name]} за {args[0]}:\n'
+        f'мин {summary["min"]:.2f}, сред {summary["avg"]:.2f}, макс {summary["max"]:.2f}\n'
+        f'последнее {summary["last"]:.2f} ({summary["points"]} точек)')
+
+def sparkline(values, width):
+    if len(values) > width:
+        step = len(values) / width
+        buckets = [values[int(i * step):int((i + 1) * step)] for i in range(width)]
+        values = [sum(bucket) / len(bucket) for bucket in buckets]
+    low, high = min(values), max(values)
+    scale = (len(SPARKLINE_BARS) - 1) / (high - low) if high > low else 0
+    return ''.join(SPARKLINE_BARS[round((value - low) * scale)] for value in values)
+
+def format_window(seconds):
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds % size == 0:
+            return f'{seconds // size}{unit}'
+    return f'{seconds}s'
+
+def render_chart(host, name, seconds):
+    series = metrics.get((host, name))
+    if series is None:
+        return None
+    # Keyed by the parsed window, so 1h and 60m share an entry, and capped
+    # at CHART_CACHE_SIZE least recently used charts.
+    key = (host, name, seconds)
+    cached = chart_cache.get(key)
+    record_cache('chart', bool(cached and cached[0] == series.version))
+    if cached and cached[0] == series.version:
+        chart_cache.move_to_end(key)
+        return cached[1]
+    values = [value for _, value in series.points(seconds)]
+    if not values:
+        return None
+    chart = (f'{METRIC_LABELS[name]} за {format_window(seconds)} ({host}):\n'
+             f'{sparkline(values, CHART_WIDTH)}\n'
+             f'мин {min(values):.2f}, макс {max(values):.2f}, последнее {values[-1]:.2f}')
+    chart_cache[key] = (series.version, chart)
+    chart_cache.move_to_end(key)
+    while len(chart_cache) > CHART_CACHE_SIZE:
+        chart_cache.popitem(last=False)
+    return chart
+
+async def chart(update: Update, context: CallbackContext) -> None:
+    if not context.args or context.args[0] not in ('load', 'mem', 'disk', 'cpu'):
+        await update.message.reply_text('Использование: /chart load|mem|disk|cpu [период, например 1h]')
+        return
+    window = context.args[1] if len(context.args) > 1 else '1h'
+    try:
+        seconds = parse_window([window])
+    except ValueError:
+        await update.message.reply_text('Неверный период. Примеры: 30m, 1h, 1d.')
+        return
+    output = render_chart(os.getenv('SSH_HOST'), context.args[0], seconds)
+    await update.message.reply_text(output or 'Нет собранных данных за этот период.')
+
+class AlertRule:
+    def __init__(self, host, metric, op, fire, clear):
+        self.host = host
+        self.metric = metric
+        self.op = op
+        self.sign = 1 if op == '>=' else -1
+        self.fire = fire
+        self.clear = clear
+        self.active = False
+
+def parse_alert_rules(spec):
+    rules = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        match = ALERT_RULE_RE.match(item)
+        if not match:
+            raise ValueError(f'Invalid alert rule: {item}')
+        fire = float(match['fire'])
+        clear = float(match['clear']) if match['clear'] else fire
+        rule = AlertRule(match['host'] or os.getenv('SSH_HOST'), match['metric'], match['op'], fire, clear)
+        if rule.sign * clear > rule.sign * fire:
+            raise ValueError(f'Alert rule clears past its threshold: {item}')
+        rules.append(rule)
+    return rules
+
+class AlertIndex:
+    # Rules sorted by threshold, so a new value only touches rules whose
+    # threshold lies between the previous and the new value.
+    def __init__(self):
+        self.value = float('-inf')
+        self.fires = []
+        self.fire_rules = []
+        self.clears = []
+        self.clear_rules = []
+
+    def add(self, rule):
+        position = bisect_right(self.fires, rule.sign * rule.fire)
+        self.fires.insert(position, rule.sign * rule.fire)
+        self.fire_rules.insert(position, rule)
+        position = bisect_right(self.clears, rule.sign * rule.clear)
+        self.clears.insert(position, rule.sign * rule.clear)
+        self.clear_rules.insert(position, rule)
+
+    def update(self, value):
+        previous, self.value = self.value, value
+        changed = []
+        if value > previous:
+            for rule in self.fire_rules[bisect_right(self.fires, previous):bisect_right(self.fires, value)]:
+                if not rule.active:
+                    rule.active = True
+                    changed.append(rule)
+        elif value < previous:
+            for rule in self.clear_rules[bisect_right(self.clears, value):bisect_right(self.clears, previous)]:
+                if rule.active:
+                    rule.active = False
+                    changed.append(rule)
+        return changed
+
+class AlertEngine:
+    def __init__(self, rules=()):
+        self.indexes = {}
+        for rule in rules:
+            self.add_rule(rule)
+
+    def add_rule(self, rule):
+        indexes = self.indexes.setdefault((rule.host, rule.metric), {})
+        indexes.setdefault(rule.sign, AlertIndex()).add(rule)
+
+    def update(self, host, metric, value):
+        if metric in EVENT_METRICS:
+            # Every batch of events over the threshold is reported, there is
+            # no state to keep or clear.
+            return [rule for sign, index in self.indexes.get((host, metric), {}).items()
+                    for rule in index.fire_rules[:bisect_right(index.fires, sign * value)]]
+        changed = []
+        for sign, index in self.indexes.get((host, metric), {}).items():
+            changed.extend(index.update(sign * value))
+        return changed
+
+    def active(self):
+        return [rule for indexes in self.indexes.values() for index in indexes.values()
+                for rule in index.fire_rules if rule.active]
+
+alert_engine = AlertEngine(parse_alert_rules(ALERT_RULES))
+
+def get_alert_subscribers():
+    global alert_subscribers
+    if alert_subscribers is None:
+        with span('db'):
+            import db
+            session = db.session()
+            alert_subscribers = {subscription.chat_id for subscription in session.query(db.Subscription).all()}
+            session.close()
+    return alert_subscribers
+
+def format_alert(rule, value, details=None):
+    label = METRIC_LABELS.get(rule.metric, rule.metric)
+    firing = rule.active or rule.metric in EVENT_METRICS
+    if firing:
+        message = f'Тревога на {rule.host}: {label} = {value:g} (порог {rule.op} {rule.fire:g})'
+    else:
+        message = f'Норма на {rule.host}: {label} = {value:g}'
+    if firing and details:
+        message += '\n' + details
+    return message
+
+async def process_alerts(context: CallbackContext, host, sample, details=None) -> None:
+    messages = []
+    for metric, value in sample.items():
+        for rule in alert_engine.update(host, metric, value):
+            messages.append(format_alert(rule, value, (details or {}).get(metric)))
+    if not messages:
+        return
+    for chat_id in await asyncio.to_thread(get_alert_subscribers):
+        for message in messages:
+            for page in paginate(message):
+                send_queue.send(context.bot, chat_id, page)
+
+def read_journal(command):
+    # Only stdout carries entries and the cursor. Anything on stderr (sudo
+    # asking for a password, journalctl errors), a timeout or a non-zero exit
+    # fails the probe instead of being counted as entries.
+    output, error, notice = run_streaming(command + '; echo "-- exit: $?"', None)
+    lines = output.splitlines()
+    if error or notice or not lines or lines[-1] != '-- exit: 0':
+        status = lines[-1] if lines and lines[-1].startswith('-- exit: ') else 'no exit status'
+        raise RuntimeError(f'journalctl failed ({status}): {(error + notice).strip()}')
+    return lines[:-1]
+
+def probe_critical_journal():
+    host = os.getenv('SSH_HOST')
+    cursor = journal_cursors.get(host)
+    if cursor is None:
+        # The first probe only records the position of the newest entry of
+        # any priority, later probes report crit entries written after it.
+        for line in read_journal('sudo -n journalctl -q --no-pager -o cat -n 1 --show-cursor'):
+            if line.startswith('-- cursor: '):
+                journal_cursors[host] = line[len('-- cursor: '):]
+        return host, []
+    command = f"sudo -n journalctl -p crit -q --no-pager -o short --show-cursor --after-cursor='{cursor}'"
+    entries = []
+    for line in read_journal(command):
+        if line.startswith('-- cursor: '):
+            journal_cursors[host] = line[len('-- cursor: '):]
+        elif line.strip():
+            entries.append(line)
+    return host, entries
+
+def fetch_replication_status():
+    cached = repl_status_cache.get('status')
+    record_cache('repl_status', bool(cached and time.monotonic() - cached[0] < REPL_STATUS_TTL))
+    if cached and time.monotonic() - cached[0] < REPL_STATUS_TTL:
+        return cached[1]
+    import db
+    with span('db'):
+        status = {
+            'replicas': db.query(REPLICATION_QUERY),
+            'receivers': db.query(WAL_RECEIVER_QUERY),
+        }
+    repl_status_cache['status'] = (time.monotonic(), status)
+    return status
+
+def probe_replication_lag():
+    status = fetch_replication_status()
+    lags = [row['lag_bytes'] for row in status['replicas'] + status['receivers'] if row['lag_bytes'] is not None]
+    return float(max(lags, default=0))
+
+async def check_alerts(context: CallbackContext) -> None:
+    try:
+        host, entries = await asyncio.to_thread(probe_critical_journal)
+        await process_alerts(context, host, {'crit': len(entries)}, {'crit': '\n'.join(entries[-10:])})
+    except Exception as e:
+        logger.warning('Journal probe failed: %s', e)
+    try:
+        lag = await asyncio.to_thread(probe_replication_lag)
+        await process_alerts(context, os.getenv('SSH_HOST'), {'repl_lag': lag})
+    except Exception as e:
+        logger.warning('Replication lag probe failed: %s', e)
+
+def add_subscription(chat_id):
+    with span('db'):
+        import db
+        session = db.session()
+        session.merge(db.Subscription(chat_id=chat_id))
+        session.commit()
+        session.close()
+
+def remove_subscription(chat_id):
+    with span('db'):
+        import db
+        session = db.session()
+        session.query(db.Subscription).filter_by(chat_id=chat_id).delete()
+        session.commit()
+        session.close()
+
+async def subscribe(update: Update, context: CallbackContext) -> None:
+    chat_id = update.effective_chat.id
+    subscribers = await asyncio.to_thread(get_alert_subscribers)
+    if chat_id not in subscribers:
+        await asyncio.to_thread(add_subscription, chat_id)
+        subscribers.add(chat_id)
+    await update.message.reply_text('Вы подписаны на оповещения.')
+
+async def unsubscribe(update: Update, context: CallbackContext) -> None:
+    chat_id = update.effective_chat.id
+    subscribers = await asyncio.to_thread(get_alert_subscribers)
+    if chat_id in subscribers:
+        await asyncio.to_thread(remove_subscription, chat_id)
+        subscribers.discard(chat_id)
+    await update.message.reply_text('Вы отписаны от оповещений.')
+
+async def get_alerts(update: Update, context: CallbackContext) -> None:
+    active = alert_engine.active()
+    if not active:
+        await update.message.reply_text('Активных тревог нет.')
+        return
+    lines = ['Активные тревоги:']
+    for rule in active:
+        lines.append(f'{rule.host}: {METRIC_LABELS.get(rule.metric, rule.metric)} {rule.op} {rule.fire:g}')
+    await update.message.reply_text('\n'.join(lines))
+
+def store_phones(phones):
+    with span('db'):
+        import db
+        session = db.session()
+        for phone in phones:
+            phone_db = db.Phone(phone=phone)
+            session.add(phone_db)
+            session.commit()
+        session.close()
+
+def store_emails(emails):
+    with span('db'):
+        import db
+        session = db.session()
+        for email in emails:
+            email_db = db.Email(email=email)
+            session.add(email_db)
+            session.commit()
+        session.close()
+
+def load_emails():
+    with span('db'):
+        import db
+        session = db.session()
+        emails = [email.email for email in session.query(db.Email).all()]
+        session.close()
+    return emails
+
+def load_phones():
+    with span('db'):
+        import db
+        session = db.session()
+        phones = [phone.phone for phone in session.query(db.Phone).all()]
+        session.close()
+    return phones
+
+def load_user_data():
+    with span('db'):
+        import db
+        session = db.session()
+        rows = {row.user_id: row.data for row in session.query(db.UserData).all()}
+        session.close()
+    return rows
+
+def write_user_data(user_id, data):
+    with span('db'):
+        import db
+        session = db.session()
+        if data is None:
+            session.query(db.UserData).filter_by(user_id=user_id).delete()
+        else:
+            session.merge(db.UserData(user_id=user_id, data=data))
+        session.commit()
+        session.close()
+
+def load_conversations(name):
+    with span('db'):
+        import db
+        session = db.session()
+        rows = {tuple(json.loads(row.key)): row.state
+                for row in session.query(db.ConversationState).filter_by(name=name).all()}
+        session.close()
+    return rows
+
+def write_conversation(name, key, state):
+    with span('db'):
+        import db
+        session = db.session()
+        if state is None:
+            session.query(db.ConversationState).filter_by(name=name, key=key).delete()
+        else:
+            session.merge(db.ConversationState(name=name, key=key, state=state))
+        session.commit()
+        session.close()
+
+class DatabasePersistence(BasePersistence):
+    # Keeps user_data and conversation states as one row per user and per
+    # conversation key. The application only passes entries touched since the
+    # last flush, and user_data equal to what was last written is skipped, so
+    # a flush costs the same however many users the bot has.
+    def __init__(self):
+        super().__init__(PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+                         update_interval=PERSISTENCE_INTERVAL)
+        self.written = {}
+
+    async def get_user_data(self):
+        try:
+            self.written = await asyncio.to_thread(load_user_data)
+        except Exception as e:
+            logger.warning('Could not load user data, starting empty: %s', e)
+            return {}
+        return {user_id: json.loads(data) for user_id, data in self.written.items()}
+
+    async def update_user_data(self, user_id, data):
+        payload = json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None
+        if self.written.get(user_id) == payload:
+            return
+        try:
+            await asyncio.to_thread(write_user_data, user_id, payload)
+        except Exception as e:
+            logger.warning('Could not store user data for %s: %s', user_id, e)
+            return
+        if payload is None:
+            self.written.pop(user_id, None)
+        else:
+            self.written[user_id] = payload
+
+    async def drop_user_data(self, user_id):
+        await self.update_user_data(user_id, {})
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_conversations(self, name):
+        try:
+            return await asyncio.to_thread(load_conversations, name)
+        except Exception as e:
+            logger.warning('Could not load conversations of %s, starting empty: %s', name, e)
+            return {}
+
+    async def update_conversation(self, name, key, new_state):
+        try:
+            await asyncio.to_thread(write_conversation, name, json.dumps(key), new_state)
+        except Exception as e:
+            logger.warning('Could not store conversation state for %s: %s', key, e)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        pass
 
 async def start(update: Update, context: CallbackContext) -> None:
     await update.message.reply_text('Привет! Я бот для поиска информации. Используйте /find_email или /find_phone_number для поиска.')
@@ -77,12 +1606,25 @@ async def verify_password(update: Update, context: CallbackContext) -> int:
     await update.message.reply_text('Пожалуйста, отправьте пароль для проверки.')
     return VERIFY_PASSWORD
 
+def set_pending(update: Update, context: CallbackContext, key, value):
+    context.user_data[key] = value
+    pending_users[update.effective_user.id] = None
+    pending_users.move_to_end(update.effective_user.id)
+    while len(pending_users) > PENDING_LIMIT:
+        user_id, _ = pending_users.popitem(last=False)
+        context.application.drop_user_data(user_id)
+
+def clear_pending(update: Update, context: CallbackContext):
+    pending_users.pop(update.effective_user.id, None)
+    for key in PENDING_KEYS:
+        context.user_data.pop(key, None)
+
 async def search_email(update: Update, context: CallbackContext) -> int:
     text = update.message.text
-    emails = re.findall(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', text)
+    emails = EMAIL_RE.findall(text)
     if emails:
         await update.message.reply_text(f'Найденные электронные адреса: {", ".join(emails)}')
-        context.user_data['text'] = text
+        set_pending(update, context, 'emails', emails)
         await update.message.reply_text('Хотите сохранить эти электронные адреса в базу данных? (да/нет)')
         return SAVE_EMAIL
     else:
@@ -91,10 +1633,10 @@ async def search_email(update: Update, context: CallbackContext) -> int:
 
 async def search_phone(update: Update, context: CallbackContext) -> int:
     text = update.message.text
-    phones = re.findall(r'\+?7[-\s]?\(?\d{3}\)?[-\s]?\d{3}[-\s]?\d{2}[-\s]?\d{2}', text)
+    phones = PHONE_RE.findall(text)
     if phones:
         await update.message.reply_text(f'Найденные номера телефонов: {", ".join(phones)}')
-        context.user_data['phones'] = phones
+        set_pending(update, context, 'phones', phones)
         await update.message.reply_text('Хотите сохранить эти номера телефонов в базу данных? (да/нет)')
         return SAVE_PHONE
     else:
@@ -104,204 +1646,454 @@ async def search_phone(update: Update, context: CallbackContext) -> int:
 async def save_phone(update: Update, context: CallbackContext) -> int:
     text = update.message.text
     if text.lower() == 'да':
-        session = sessionmaker(bind=engine)()
-        for phone in context.user_data['phones']:
-            phone_db = Phone(phone=phone)
-            session.add(phone_db)
-            session.commit()
-        await update.message.reply_text('Номера телефонов сохранены в базу данных.')
+        if 'phones' in context.user_data:
+            await asyncio.to_thread(store_phones, context.user_data['phones'])
+            await update.message.reply_text('Номера телефонов сохранены в базу данных.')
+        else:
+            await update.message.reply_text('Номера телефонов для сохранения не найдены.')
     else:
         await update.message.reply_text('Номера телефонов не сохранены.')
+    clear_pending(update, context)
     return ConversationHandler.END
 
 async def save_email(update: Update, context: CallbackContext) -> int:
     text = update.message.text
     if text.lower() == 'да':
-        if 'text' in context.user_data:
-            emails = re.findall(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', context.user_data['text'])
-            session = sessionmaker(bind=engine)()
-            for email in emails:
-                email_db = Email(email=email)
-                session.add(email_db)
-                session.commit()
+        if 'emails' in context.user_data:
+            await asyncio.to_thread(store_emails, context.user_data['emails'])
             await update.message.reply_text('Электронные адреса сохранены в базу данных.')
         else:
-            await update.message.reply_text('Текст не найден.')
+            await update.message.reply_text('Электронные адреса для сохранения не найдены.')
     else:
         await update.message.reply_text('Электронные адреса не сохранены.')
+    clear_pending(update, context)
     return ConversationHandler.END
 
+async def cancel(update: Update, context: CallbackContext) -> int:
+    cancelled = [event for event in running_commands.get(update.effective_chat.id, ())
+                 if event is not current_cancel.get() and not event.is_set()]
+    for event in cancelled:
+        event.set()
+    clear_pending(update, context)
+    if cancelled:
+        await update.message.reply_text(f'Отменено команд: {len(cancelled)}.')
+    else:
+        await update.message.reply_text('Нет выполняющихся команд, диалог сброшен.')
+    return ConversationHandler.END
+
+async def conversation_timeout(update: Update, context: CallbackContext) -> None:
+    clear_pending(update, context)
+    context.application.mark_data_for_update_persistence(user_ids=update.effective_user.id)
+    await update.effective_message.reply_text('Время ожидания ответа истекло, начните заново.')
+
 async def check_password(update: Update, context: CallbackContext) -> int:
     password = update.message.text
-    pattern = r'^(?=.*[A-Z])(?=.*[a-z])(?=.*\d)(?=.*[@$!%*#?&])[A-Za-z\d@$!%* #?&]{8,}$'
-    if re.match(pattern, password):
+    if PASSWORD_RE.match(password):
         await update.message.reply_text('Пароль сложный.')
     else:
         await update.message.reply_text('Пароль простой.')
     return ConversationHandler.END
 
 async def help(update: Update, context: CallbackContext) -> None:
-    await update.message.reply_text('Доступные команды:\n'
-                                   '/start - начать работу с ботом\n'
-                                   '/find_email - найти email-адреса\n'
-                                   '/find_phone_number - найти номера телефонов\n'
-                                   '/verify_password - проверить пароль\n'
-                                   '/get_release - получить информацию о релизе\n'
-                                   '/get_uname - получить информацию о системе\n'
-                                   '/get_uptime - получить информацию о времени работы\n'
-                                   '/get_df - получить информацию о файловой системе\n'
-                                   '/get_free - получить информацию о свободной памяти\n'
-                                   '/get_mpstat - получить информацию о производительности\n'
-                                   '/get_w - получить информацию о работающих пользователях\n'
-                                   '/get_auths - получить информацию о последних входах\n'
-                                   '/get_critical - получить информацию о критических событиях\n'
-                                   '/get_ps - получить информацию о запущенных процессах\n'
-                                   '/get_ss - получить информацию о используемых портах\n'
-                                   '/get_apt_list - получить информацию о установленных пакетах\n'
-                                   '/get_services - получить информацию о запущенных сервисах\n'
-                                   '/help - список доступных команд\n'
-                                   '/get_repl_logs - получить лог репликации\n'
-                                   '/get_emails - получить список email-адресов\n'
-                                   '/get_phone_numbers - получить список номеров телефонов\n'
-                                   '/get_repl_logs - rep-logs')
-
-async def get_release(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'cat /etc/os-release')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_uname(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'uname -a')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_uptime(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'uptime')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_df(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'df -h')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_free(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'free -h')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_mpstat(update: Update, context: CallbackContext ) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'mpstat -a')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_w(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'w')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_auths(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'last')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_critical(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'sudo journalctl -p crit')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_ps(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'ps aux')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_ss(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'ss -tunap')
-    ssh_client.close()
-    await update.message.reply_text(output)
-
-async def get_apt_list(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'apt list --installed')
-    ssh_client.close()
-    await update.message.reply_text(output)
+    lines = ['Доступные команды:']
+    for command in COMMANDS:
+        usage = f' {command.usage}' if command.usage else ''
+        lines.append(f'/{command.name}{usage} - {command.description}')
+    await update.message.reply_text('\n'.join(lines))
+
+class Command:
+    def __init__(self, name, callback, description, usage='', cost='cheap'):
+        self.name = name
+        self.callback = callback
+        self.description = description
+        self.usage = usage
+        self.cost = cost
+
+class RemoteCommand(Command):
+    # A shell command run on SSH_HOST. ttl > 0 answers from the last output for
+    # that many seconds, parser turns the output into the reply, stream sends
+    # output while the command runs and history answers "/name <period>" from
+    # the collected metric of that name. snapshot maps an output line to the
+    # item it describes (or None) and enables "/name diff". proc is a pair of
+    # /proc files and a function rendering them, used instead of the command
+    # with PROBE_MODE=proc, and on a local host too unless proc_local is off.
+    def __init__(self, name, command, description, usage='', cost='expensive', ttl=0, timeout=None,
+                 parser=None, stream=False, history=None, header='', snapshot=None, proc=None, proc_local=True):
+        async def callback(update: Update, context: CallbackContext) -> None:
+            await self.handle(update, context)
+        callback.__name__ = name
+        super().__init__(name, callback, description, usage, cost)
+        self.command = command
+        self.ttl = ttl
+        self.timeout = timeout
+        self.parser = parser
+        self.stream = stream
+        self.history = history
+        self.header = header
+        self.snapshot = snapshot
+        self.proc = proc
+        self.proc_local = proc_local
+
+    def uses_proc(self):
+        if self.proc is None:
+            return False
+        return PROBE_MODE == 'proc' or (self.proc_local and is_local_host(os.getenv('SSH_HOST')))
+
+    def fetch(self):
+        if self.uses_proc():
+            paths, render = self.proc
+            return render(read_proc_files(paths))
+        return run_command(self.command, self.timeout)
+
+    def fetch_output(self):
+        # stdout, stderr and the notice apart, so a warning on stderr (apt list
+        # prints one on every run) does not replace the snapshot source.
+        if self.uses_proc():
+            paths, render = self.proc
+            return render(read_proc_files(paths)), '', ''
+        return run_streaming(self.command, None, self.timeout)
+
+    def run(self):
+        key = (os.getenv('SSH_HOST'), self.name)
+        if self.ttl:
+            cached = command_cache.get(key)
+            hit = bool(cached and time.monotonic() - cached[0] < self.ttl)
+            record_cache(self.name, hit)
+            if hit:
+                return cached[1]
+        output = self.fetch()
+        if self.ttl:
+            command_cache[key] = (time.monotonic(), output)
+        return output
+
+    def diff(self, output):
+        key = (os.getenv('SSH_HOST'), self.name)
+        current = {item for item in map(self.snapshot, output.splitlines()) if item}
+        previous = snapshots.get(key)
+        snapshots[key] = current
+        if previous is None:
+            return None
+        return [f'+ {item}' for item in sorted(current - previous)] + [f'- {item}' for item in sorted(previous - current)]
+
+    async def handle(self, update: Update, context: CallbackContext) -> None:
+        if self.snapshot and context.args and context.args[0].lower() == 'diff':
+            output, error, notice = await asyncio.to_thread(self.fetch_output)
+            if notice or (error and not output.strip()):
+                # A cut or failed run would show every item as removed.
+                await reply_long(update, (error + notice).strip())
+                return
+            changes = self.diff(output)
+            if changes is None:
+                text = 'Предыдущий снимок не сохранён, изменения появятся при следующем запросе.'
+            elif not changes:
+                text = 'Изменений нет.'
+            else:
+                text = '\n'.join([f'Изменения /{self.name}:'] + changes)
+            if error.strip():
+                text += '\n\n' + error.strip()
+            await reply_long(update, text)
+            return
+        if self.history and context.args:
+            await reply_history(update, self.history, context.args)
+            return
+        if self.stream and not self.uses_proc():
+            output, error, notice = await stream_reply(update, self.command, self.header, self.timeout)
+        else:
+            output, error, notice = await asyncio.to_thread(self.run), '', ''
+            await reply_long(update, self.header + (self.parser(output) if self.parser else output))
+        # Same rule as the diff branch: a cut or failed run is no snapshot.
+        if self.snapshot and not notice and not (error and not output.strip()):
+            self.diff(output)
+
+def process_item(line):
+    parts = line.split(None, 10)
+    if len(parts) < 11 or not parts[1].isdigit():
+        return None
+    return f'{parts[1]} {parts[0]} {parts[10]}'
+
+def socket_item(line):
+    parts = line.split()
+    if len(parts) < 6 or parts[0] == 'Netid':
+        return None
+    return ' '.join(parts[:2] + parts[4:])
+
+def package_item(line):
+    return line.strip() if '/' in line else None
+
+def parse_services(output):
+    services = {}
+    for line in output.splitlines():
+        parts = line.lstrip('● ').split(None, 4)
+        if len(parts) < 4 or not parts[0].endswith('.service'):
+            continue
+        unit, load, active, sub = parts[:4]
+        services[unit] = {
+            'load': load,
+            'active': active,
+            'sub': sub,
+            'description': parts[4] if len(parts) > 4 else '',
+        }
+    return services
+
+def fetch_services(force=False):
+    host = os.getenv('SSH_HOST')
+    cached = services_cache.get(host)
+    hit = bool(cached and not force and time.monotonic() - cached['time'] < SERVICES_CACHE_TTL)
+    record_cache('services', hit)
+    if hit:
+        return cached['table'], cached['previous']
+
+    output = run_command(SERVICES_COMMAND)
+
+    table = parse_services(output)
+    previous = cached['table'] if cached else None
+    services_cache[host] = {'time': time.monotonic(), 'table': table, 'previous': previous}
+    return table, previous
+
+def diff_services(previous, current):
+    changes = []
+    for unit in sorted(set(previous) | set(current)):
+        old, new = previous.get(unit), current.get(unit)
+        if old is None:
+            changes.append(f'+ {unit} {new["active"]}/{new["sub"]}')
+        elif new is None:
+            changes.append(f'- {unit} {old["active"]}/{old["sub"]}')
+        elif (old['active'], old['sub']) != (new['active'], new['sub']):
+            changes.append(f'~ {unit} {old["active"]}/{old["sub"]} -> {new["active"]}/{new["sub"]}')
+    return changes
+
+def filter_services(table, args):
+    patterns = [arg for arg in args if arg not in ('failed', 'running')]
+    patterns = [p if any(c in p for c in '*?[') else f'*{p}*' for p in patterns]
+    rows = []
+    for unit, service in table.items():
+        if 'failed' in args and service['active'] != 'failed':
+            continue
+        if 'running' in args and service['sub'] != 'running':
+            continue
+        if patterns and not any(fnmatch(unit.lower(), p) for p in patterns):
+            continue
+        rows.append((unit, service))
+    rows.sort(key=lambda row: (SERVICE_STATE_ORDER.get(row[1]['active'], len(SERVICE_STATE_ORDER)), row[0]))
+    return rows
 
 async def get_services(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'systemctl list-units --type=service')
-    ssh_client.close()
-    await update.message.reply_text(output)
+    args = [arg.lower() for arg in context.args]
+
+    if 'changes' in args or 'diff' in args:
+        table, previous = await asyncio.to_thread(fetch_services, True)
+        if previous is None:
+            await update.message.reply_text('Предыдущее состояние сервисов не сохранено, изменения появятся при следующем запросе.')
+            return
+        changes = diff_services(previous, table)
+        await update.message.reply_text('\n'.join(['Изменения сервисов:'] + changes) if changes else 'Изменений в сервисах нет.')
+        return
+
+    table, _ = await asyncio.to_thread(fetch_services)
+    rows = filter_services(table, args)
+    failed = sum(1 for service in table.values() if service['active'] == 'failed')
+    running = sum(1 for service in table.values() if service['sub'] == 'running')
+    lines = [f'Сервисы: всего {len(table)}, работают {running}, с ошибкой {failed}']
+    for unit, service in rows:
+        lines.append(f'{unit} {service["active"]}/{service["sub"]} {service["description"]}'.rstrip())
+    if not rows:
+        lines.append('Подходящих сервисов нет.')
+    await reply_long(update, '\n'.join(lines))
 
 async def get_emails(update: Update, context: CallbackContext) -> None:
-    session = sessionmaker(bind=engine)()
-    emails = session.query(Email).all()
-    email_list = [email.email for email in emails]
-    await update.message.reply_text(f'Список email-адресов: {", ".join(email_list)}')
+    email_list = await asyncio.to_thread(load_emails)
+    await reply_long(update, f'Список email-адресов: {", ".join(email_list)}')
 
 async def get_phone_numbers(update: Update, context: CallbackContext) -> None:
-    session = sessionmaker(bind=engine)()
-    phones = session.query(Phone).all()
-    phone_list = [phone.phone for phone in phones]
-    await update.message.reply_text(f'Список номеров телефонов: {", ".join(phone_list)}')
-async def get_repl_logs(update: Update, context: CallbackContext) -> None:
-    ssh_client = connect_to_server()
-    output = execute_command(ssh_client, 'sudo cat /var/log/postgresql/logfile')
-    logs = output.split('\n')
-    info_string = 'Логи репликации PostgreSQL:\n'
-    for log in logs:
-        info_string += log + '\n'
-    ssh_client.close()
-    await update.message.reply_text(info_string)
+    phone_list = await asyncio.to_thread(load_phones)
+    await reply_long(update, f'Список номеров телефонов: {", ".join(phone_list)}')
+
+async def get_repl_status(update: Update, context: CallbackContext) -> None:
+    try:
+        status = await asyncio.to_thread(fetch_replication_status)
+    except Exception as e:
+        logger.warning('Replication status query failed: %s', e)
+        await update.message.reply_text('Не удалось получить статус репликации.')
+        return
+
+    def lag(row):
+        lag_bytes = f'{int(row["lag_bytes"])} байт' if row['lag_bytes'] is not None else '? байт'
+        lag_seconds = f'{float(row["lag_seconds"]):.2f} с' if row['lag_seconds'] is not None else '? с'
+        return f'отставание {lag_bytes}, {lag_seconds}'
+
+    lines = ['Статус репликации PostgreSQL:']
+    for row in status['replicas']:
+        lines.append(f'{row["application_name"]} ({row["client_addr"]}): {row["state"]}, {row["sync_state"]}, {lag(row)}')
+    for row in status['receivers']:
+        lines.append(f'Приём WAL от {row["sender_host"]}:{row["sender_port"]}: {row["status"]}, {lag(row)}')
+    if len(lines) == 1:
+        lines.append('Реплики не подключены.')
+    await update.message.reply_text('\n'.join(lines))
+
+async def stats(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text('Команда доступна только администраторам.')
+        return
+    lines = ['Задержки (n, ошибки, сред/p50/p95/макс, мс):']
+    for phase, histogram in sorted(phase_stats.items()):
+        lines.append(f'{phase}: n={histogram.count} err={error_counts.get(phase, 0)} '
+                     f'{histogram.sum / histogram.count * 1000:.0f}/{histogram.quantile(0.5) * 1000:.0f}/'
+                     f'{histogram.quantile(0.95) * 1000:.0f}/{histogram.max * 1000:.0f}')
+    for name, histogram in sorted(output_sizes.items()):
+        lines.append(f'{name}: n={histogram.count} сред {histogram.sum / histogram.count:.0f} байт, макс {histogram.max:.0f} байт')
+    for name, stats in sorted(cache_stats.items()):
+        lines.append(f'кэш {name}: попаданий {stats["hit"]}, промахов {stats["miss"]}')
+    for cost_class in RATE_LIMITS:
+        lines.append(f'лимит {cost_class}: пропущено {limiter_stats["allowed"].get(cost_class, 0)}, '
+                     f'отклонено {limiter_stats["rejected"].get(cost_class, 0)}')
+    lines.append(f'ожиданий отправки: {limiter_stats["send_waits"]}, всего {limiter_stats["send_wait_seconds"]:.1f} с')
+    lines.append(f'очередь отправки: {send_queue.depth()} сообщений, отправлено {send_queue.sent}, '
+                 f'объединено {send_queue.coalesced}, повторов после 429: {send_queue.retries}')
+    if gzip_stats['commands']:
+        lines.append(f'сжатие SSH: {gzip_stats["commands"]} команд, {gzip_stats["wire_bytes"]} байт передано '
+                     f'вместо {gzip_stats["raw_bytes"]}')
+    await update.message.reply_text('\n'.join(lines))
+
+async def profile(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text('Команда доступна только администраторам.')
+        return
+    argument = context.args[0].lower() if context.args else str(PROFILE_SECONDS)
+    if argument == 'stop':
+        if profile_state['profiler'] is None:
+            await update.message.reply_text('Профилирование не запущено.')
+            return
+        await finish_profile(context.application, update.effective_chat.id)
+        return
+    if profile_state['profiler'] is not None:
+        await update.message.reply_text('Профилирование уже запущено. Остановить: /profile stop')
+        return
+    try:
+        if argument.endswith('u'):
+            updates = int(argument[:-1])
+            if updates <= 0:
+                raise ValueError(argument)
+            start_profile(context.application, update.effective_chat.id, updates=updates)
+            await update.message.reply_text(f'Профилирование запущено на {updates} обновлений.')
+        else:
+            seconds = int(argument)
+            if seconds <= 0:
+                raise ValueError(argument)
+            start_profile(context.application, update.effective_chat.id, seconds=seconds)
+            await update.message.reply_text(f'Профилирование запущено на {seconds} с.')
+    except ValueError:
+        await update.message.reply_text('Использование: /profile [секунды|Nu|stop], например /profile 30 или /profile 100u')
+
+COMMANDS = [
+    Command('start', start, 'начать работу с ботом'),
+    Command('help', help, 'список доступных команд'),
+    Command('find_email', find_email, 'найти email-адреса'),
+    Command('find_phone_number', find_phone_number, 'найти номера телефонов'),
+    Command('verify_password', verify_password, 'проверить пароль'),
+    RemoteCommand('get_release', 'cat /etc/os-release', 'получить информацию о релизе', ttl=3600),
+    RemoteCommand('get_uname', 'uname -a', 'получить информацию о системе', ttl=3600),
+    RemoteCommand('get_uptime', 'uptime', 'получить информацию о времени работы (или нагрузку за период, например 1h)',
+                  usage='[период]', history='load', proc=(('/proc/uptime', '/proc/loadavg'), render_uptime)),
+    RemoteCommand('get_df', 'df -h', 'получить информацию о файловой системе', usage='[период]', history='disk'),
+    RemoteCommand('get_free', 'free -h', 'получить информацию о свободной памяти', usage='[период]', history='mem',
+                  proc=(('/proc/meminfo',), render_free)),
+    RemoteCommand('get_mpstat', 'mpstat -a', 'получить информацию о производительности', usage='[период]',
+                  history='cpu', proc=(('/proc/stat',), render_mpstat)),
+    RemoteCommand('get_w', 'w', 'получить информацию о работающих пользователях'),
+    RemoteCommand('get_auths', 'last', 'получить информацию о последних входах', stream=True),
+    RemoteCommand('get_critical', 'sudo -n journalctl -p crit', 'получить информацию о критических событиях',
+                  stream=True),
+    # ps aux without the probe's own session (its shell, timeout, gzip and ps
+    # itself), which would otherwise show up as new processes in every diff.
+    RemoteCommand('get_ps', PS_COMMAND, 'получить информацию о запущенных процессах', usage='[diff]', stream=True,
+                  snapshot=process_item),
+    RemoteCommand('get_ss', 'ss -tunap', 'получить информацию о используемых портах', usage='[diff]', stream=True,
+                  snapshot=socket_item, proc=(SOCKET_PROC_FILES, render_sockets), proc_local=False),
+    RemoteCommand('get_apt_list', 'apt list --installed', 'получить информацию о установленных пакетах',
+                  usage='[diff]', stream=True, timeout=120, snapshot=package_item),
+    Command('get_services', get_services, 'получить информацию о запущенных сервисах',
+            usage='[failed|running|changes|diff|шаблон]', cost='expensive'),
+    RemoteCommand('get_repl_logs', 'sudo -n cat /var/log/postgresql/logfile', 'получить лог репликации',
+                  stream=True, header='Логи репликации PostgreSQL:\n'),
+    Command('get_emails', get_emails, 'получить список email-адресов'),
+    Command('get_phone_numbers', get_phone_numbers, 'получить список номеров телефонов'),
+    Command('subscribe', subscribe, 'подписаться на оповещения'),
+    Command('unsubscribe', unsubscribe, 'отписаться от оповещений'),
+    Command('get_alerts', get_alerts, 'активные тревоги'),
+    Command('chart', chart, 'график метрики', usage='load|mem|disk|cpu [период]'),
+    Command('get_repl_status', get_repl_status, 'статус и отставание репликации'),
+    Command('stats', stats, 'статистика задержек (для администраторов)'),
+    Command('profile', profile, 'профилирование бота (для администраторов)', usage='[секунды|Nu|stop]'),
+    Command('cancel', cancel, 'отменить выполняющиеся команды и сбросить диалог'),
+]
+COMMAND_COSTS = {command.name: command.cost for command in COMMANDS}
+
+async def publish_commands(application: Application) -> None:
+    try:
+        await application.bot.set_my_commands([BotCommand(command.name, command.description) for command in COMMANDS])
+    except Exception as e:
+        logger.warning('Could not publish the command menu: %s', e)
+
 def main():
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        # Without it PTB registers the local listen address with Telegram,
+        # which can never reach it.
+        raise ValueError('BOT_MODE=webhook requires WEBHOOK_URL, the public HTTPS address of the webhook')
     TOKEN = os.getenv('TOKEN')
-    application = Application.builder().token(TOKEN).build()
+    builder = (Application.builder().token(TOKEN)
+               .request(InstrumentedRequest(connection_pool_size=256))
+               .concurrent_updates(PerChatUpdateProcessor(max(CONCURRENT_UPDATES, 1)))
+               .post_init(post_init)
+               .post_shutdown(post_shutdown))
+    if os.getenv('TELEGRAM_BASE_URL'):
+        builder = builder.base_url(os.getenv('TELEGRAM_BASE_URL'))
+    if PERSISTENCE_INTERVAL > 0:
+        # Opt-in: PTB loads persisted state inside initialize(), so the
+        # database round-trip is back on the startup path.
+        builder = builder.persistence(DatabasePersistence())
+    application = builder.build()
 
     conv_handler = ConversationHandler(
-    entry_points=[CommandHandler('start', start), 
-                  CommandHandler('find_email', find_email), 
-                  CommandHandler('find_phone_number', find_phone_number), 
-                  CommandHandler('verify_password', verify_password), 
-                  CommandHandler('help', help),
-                  CommandHandler('get_release', get_release),
-                  CommandHandler('get_uname', get_uname),
-                  CommandHandler('get_uptime', get_uptime),
-                  CommandHandler('get_df', get_df),
-                  CommandHandler('get_free', get_free),
-                  CommandHandler('get_mpstat', get_mpstat),
-                  CommandHandler('get_w', get_w),
-                  CommandHandler('get_auths', get_auths),
-                  CommandHandler('get_critical', get_critical),
-                  CommandHandler('get_ps', get_ps),
-                  CommandHandler('get_ss', get_ss),
-                  CommandHandler('get_apt_list', get_apt_list),
-                  CommandHandler('get_services', get_services),
-                  CommandHandler('get_repl_logs', get_repl_logs),
-                  CommandHandler('get_emails', get_emails),
-                  CommandHandler('get_phone_numbers', get_phone_numbers),],
+    entry_points=[CommandHandler(command.name, command.callback) for command in COMMANDS],
     states={
-        FIND_EMAIL: [MessageHandler(filters.TEXT, search_email)],
-        FIND_PHONE: [MessageHandler(filters.TEXT, search_phone)],
-        VERIFY_PASSWORD: [MessageHandler(filters.TEXT, check_password)],
-        SAVE_EMAIL: [MessageHandler(filters.TEXT, save_email)],
-        SAVE_PHONE: [MessageHandler(filters.TEXT, save_phone)],
+        FIND_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, search_email)],
+        FIND_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, search_phone)],
+        VERIFY_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, check_password)],
+        SAVE_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_email)],
+        SAVE_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_phone)],
+        ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
     },
-    fallbacks=[CommandHandler('start', start)],
+    fallbacks=[CommandHandler('start', start), CommandHandler('cancel', cancel)],
+    conversation_timeout=CONVERSATION_TIMEOUT or None,
+    name='main',
+    persistent=PERSISTENCE_INTERVAL > 0,
     )
 
+    for handler in conv_handler.entry_points + conv_handler.fallbacks + [
+            handler for handlers in conv_handler.states.values() for handler in handlers]:
+        handler.callback = instrumented(handler.callback)
+
+    application.add_handler(TypeHandler(Update, rate_limit), group=-1)
     application.add_handler(conv_handler)
 
-    application.run_polling()
+    if METRICS_INTERVAL > 0:
+        application.job_queue.run_repeating(collect_metrics, interval=METRICS_INTERVAL, first=1)
+    if ALERT_INTERVAL > 0:
+        application.job_queue.run_repeating(check_alerts, interval=ALERT_INTERVAL, first=5)
+
+    if BOT_MODE == 'webhook':
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            cert=WEBHOOK_CERT,
+            key=WEBHOOK_KEY,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,54 @@
+import os
+import threading
+from sqlalchemy import create_engine, text, Column, String, Integer, BigInteger, Text
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+engine = create_engine(os.getenv('DATABASE_URL') or f'postgresql://{os.getenv("DB_USER")}:{os.getenv("DB_PASSWORD")}@{os.getenv("DB_HOST")}:{os.getenv("DB_PORT")}/{os.getenv("DB_DATABASE")}')
+Base = declarative_base()
+Session = sessionmaker(bind=engine)
+schema_lock = threading.Lock()
+schema_ready = False
+
+class Email(Base):
+    __tablename__ = 'emails'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    email = Column(String, nullable=False)
+
+    def __init__(self, email):
+        self.email = email
+
+class Phone(Base):
+    __tablename__ = 'phones'
+    id = Column(String, primary_key=True)
+    phone = Column(String)
+
+class Subscription(Base):
+    __tablename__ = 'alert_subscriptions'
+    chat_id = Column(BigInteger, primary_key=True)
+
+class UserData(Base):
+    __tablename__ = 'user_data'
+    user_id = Column(BigInteger, primary_key=True)
+    data = Column(Text, nullable=False)
+
+class ConversationState(Base):
+    __tablename__ = 'conversation_states'
+    name = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    state = Column(Integer, nullable=False)
+
+def init_schema():
+    global schema_ready
+    with schema_lock:
+        if not schema_ready:
+            Base.metadata.create_all(engine)
+            schema_ready = True
+
+def session():
+    if not schema_ready:
+        init_schema()
+    return Session()
+
+def query(sql):
+    with engine.connect() as connection:
+        return [dict(row._mapping) for row in connection.execute(text(sql))]